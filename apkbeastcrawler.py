@@ -12,7 +12,6 @@ import logging
 import multiprocessing
 import os
 import re
-import requests
 import sys
 
 from bs4 import BeautifulSoup
@@ -20,7 +19,13 @@ import unicodedata
 
 from debug import Debug
 from apkhelper import ApkVersionInfo
-from reporthelper import ReportHelper
+from claimhelper import claimDownload, claimRun, releaseDownload, saveDownload
+from httphelper import getSession, readChunk
+from retryhelper import logMetrics
+from timeouthelper import getTimeout, mapWithinBudget
+from streamhelper import isStreamingStdout, openStream, streamDownload
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, loadReport
 
 ###################
 # DEBUG VARS      #
@@ -49,6 +54,7 @@ class ApkBeastCrawler(object):
         self.report      = report
         self.dlFiles     = dlFiles
         self.dlFilesBeta = dlFilesBeta
+        self.skipped     = []  # What was not checked within the crawl budget, see mapWithinBudget()
 
         self.sReDownloadUrl = "var url = '(?P<URL>.*)';"
         self.reDownloadUrl  = re.compile(self.sReDownloadUrl)
@@ -59,9 +65,9 @@ class ApkBeastCrawler(object):
         """
         link      = ''
 
-        session = requests.Session()
+        session = getSession(url, self.__class__.__name__)
         logging.debug('Requesting2: ' + url)
-        resp    = session.get(url)
+        resp    = session.get(url, timeout=getTimeout('detail'))
         if resp.status_code == http.client.OK:
             html    = unicodedata.normalize('NFKD', resp.text)
 
@@ -105,16 +111,23 @@ class ApkBeastCrawler(object):
                 logging.info('{0} already exists (in ../apkcrawler/)'.format(apkname))
                 return
 
+            if not claimDownload(avi):
+                return
+
             # Open the url
-            session = requests.Session()
-            r = session.get(url)
+            session = getSession(url, self.__class__.__name__)
+            r = session.get(url, stream=True, timeout=getTimeout('download'))
 
-            with open(apkname, 'wb') as local_file:
-                local_file.write(r.content)
+            if not saveDownload(apkname, r.iter_content(readChunk)):
+                releaseDownload(avi)
+                return
 
+            self.report.recordDownload(avi)
+            streamDownload(apkname, avi, isBeta)
             logging.debug(('beta:' if isBeta else 'reg :') + apkname)
             return       (('beta:' if isBeta else ''     ) + apkname)
         except OSError:
+            releaseDownload(avi)
             logging.exception('!!! Filename is not valid: "{0}"'.format(apkname))
     # END: def downloadApk
 
@@ -126,9 +139,9 @@ class ApkBeastCrawler(object):
 
         url       = 'http://apkbeast.com/' + apkid
 
-        session = requests.Session()
+        session = getSession(url, self.__class__.__name__)
         logging.debug('Requesting1: ' + url)
-        resp    = session.get(url)
+        resp    = session.get(url, timeout=getTimeout('listing'))
         if resp.status_code == http.client.OK:
             html    = unicodedata.normalize('NFKD', resp.text).encode('ascii', 'ignore')
 
@@ -164,15 +177,16 @@ class ApkBeastCrawler(object):
         crawl(): check all apk-dl apps
         """
         # Start checking all apkids ...
-        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5)  # Run only 5 tasks before re-placing the process
-        r = p.map_async(unwrap_self_checkOneApp, list(zip([self] * len(list(self.report.getAllApkIds())), list(self.report.getAllApkIds()))), callback=unwrap_callback)
-        r.wait()
+        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5, initializer=unwrap_init, initargs=(self,))  # Run only 5 tasks before re-placing the process
+        (results, self.skipped) = mapWithinBudget(p, unwrap_self_checkOneApp, list(self.report.getAllApkIds()), self.__class__.__name__)
+        unwrap_callback(results)
         (self.dlFiles, self.dlFilesBeta) = unwrap_getresults()
     # END: crawl():
 # END: class ApkBeastCrawler
 
 nonbeta = []
 beta    = []
+worker  = None  # the crawler in a pool process, see unwrap_init()
 
 
 def unwrap_callback(results):
@@ -188,8 +202,15 @@ def unwrap_getresults():
     return (nonbeta, beta)
 
 
-def unwrap_self_checkOneApp(arg, **kwarg):
-    return ApkBeastCrawler.checkOneApp(*arg, **kwarg)
+def unwrap_init(crawler):
+    global worker
+    worker = crawler
+
+
+def unwrap_self_checkOneApp(arg):
+    if worker.report.isSatisfied():  # Nothing left to find
+        return None
+    return worker.checkOneApp(arg)
 
 
 if __name__ == "__main__":
@@ -199,30 +220,34 @@ if __name__ == "__main__":
     logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    lines = ''
-    if len(sys.argv[1:]) == 1:
-        with open(sys.argv[1]) as report:
-            lines = report.readlines()
+    if len(sys.argv[1:]) == 1 and os.path.isdir(sys.argv[1]):
+        report = buildReport(sys.argv[1])
+    elif len(sys.argv[1:]) == 1:
+        with open(sys.argv[1]) as lines:
+            report = loadReport(lines)
     else:
-        lines = sys.stdin.readlines()
-
-    report = ReportHelper(lines)
+        report = loadReport(sys.stdin)
 
     if len(list(report.getAllApkIds())) == 0:
         print('ERROR: expecting:')
         print(' - 1 parameter (report file from output of report_sources.sh)')
         print(' or ')
+        print(' - 1 parameter (Open GApps sources directory)')
+        print(' or ')
         print(' - stdin from report_sources.sh')
         exit(1)
 
     crawler = ApkBeastCrawler(report)
-    crawler.crawl()
+    openStream()  # Before the pool forks, so all its workers share the stream
+    with claimRun():
+        crawler.crawl()
+        logMetrics()
 
     outputString = ' '.join(crawler.dlFiles)
     if crawler.dlFilesBeta:
         outputString += ' beta ' + ' '.join(crawler.dlFilesBeta)
 
-    if outputString:
+    if outputString and not isStreamingStdout():
         print(outputString)
         sys.stdout.flush()
 
@@ -1,29 +1,239 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import importlib
 import logging
+import multiprocessing
 import os
+import queue
 import sys
+import time
 
 from debug import Debug
-from reporthelper import ReportHelper
-from apkbeastcrawler import ApkBeastCrawler
-from apkdlcrawler import ApkdlCrawler
-from apkmirrorcrawler import ApkMirrorCrawler
-from apkpurecrawler import ApkPureCrawler
-from aptoidecrawler import AptoideCrawler
-from mobogeniecrawler import MobogenieCrawler
-from playstorecrawler import PlayStoreCrawler
-from plazzacrawler import PlazzaCrawler
-from uptodowncrawler import UptodownCrawler
-
-from aptoidecrawler import StoresException as AptoideStoresException
-from playstorecrawler import CredentialsException as PlayStoreCredentialsException
+from claimhelper import abandonProcess, cancelCrawl, claimRun, watchCancel
+from historyhelper import getScore, loadHistory, recordRun, saveHistory
+from retryhelper import logMetrics
+from streamhelper import isStreamingStdout, startStream
+from timeouthelper import getRemaining, startBudget
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, loadReport
+
+# The sources by name: (module, crawler class, exceptions that end its crawl with a message,
+# threads), where threads is the number of concurrent requests its host is known to accept
+# A source is only imported when it is selected, see loadSources()
+allSources = collections.OrderedDict([
+    ('apkbeast',  ('apkbeastcrawler',  'ApkBeastCrawler',  (),                        3)),  # APKBeast kills the connection if too many threads
+    ('apkdl',     ('apkdlcrawler',     'ApkdlCrawler',     (),                        5)),
+    ('apkmirror', ('apkmirrorcrawler', 'ApkMirrorCrawler', (),                        5)),
+    ('apkpure',   ('apkpurecrawler',   'ApkPureCrawler',   (),                        5)),
+    ('aptoide',   ('aptoidecrawler',   'AptoideCrawler',   ('StoresException',),      5)),
+    ('mobogenie', ('mobogeniecrawler', 'MobogenieCrawler', (),                        5)),
+    ('playstore', ('playstorecrawler', 'PlayStoreCrawler', ('CredentialsException',), 4)),
+    ('plazza',    ('plazzacrawler',    'PlazzaCrawler',    (),                        5)),
+    ('uptodown',  ('uptodowncrawler',  'UptodownCrawler',  (),                        5)),
+])
+
+# Seconds a crawler that lost a race gets to stop by itself before it is killed
+raceGrace = 30
 
 # logging
 logFile   = '{0}.log'.format(os.path.basename(__file__))
 logLevel  = (logging.DEBUG if Debug.DEBUG else logging.INFO)
 logFormat = '%(asctime)s %(levelname)s/%(funcName)s(%(process)-5d): %(message)s'
 
+
+def positiveInt(value):
+    """
+    positiveInt(value): argparse type for a whole number of at least 1
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('expecting a whole number of at least 1, not "{0}"'.format(value))
+    return number
+# END: def positiveInt
+
+
+def loadSources(names, report):
+    """
+    loadSources(names, report): Import only the named sources and return their crawlers for report
+    """
+    crawlers = []
+    for name in names:
+        (moduleName, className, errorNames, threads) = allSources[name]
+        module  = importlib.import_module(moduleName)
+        crawler = getattr(module, className)(report)
+        crawler.sourceErrors  = tuple(getattr(module, errorName) for errorName in errorNames)
+        crawler.sourceThreads = threads
+        crawlers.append(crawler)
+    return crawlers
+# END: def loadSources
+
+
+def getErrorMessage(crawler, e):
+    """
+    getErrorMessage(crawler, e): The message for one of the sourceErrors of crawler,
+                                 e.g. 'AptoideStoresException: <error>'
+    """
+    return '{0}{1}: {2}'.format(crawler.__class__.__name__.replace('Crawler', ''), e.__class__.__name__, e)
+# END: def getErrorMessage
+
+
+def crawlOne(crawler, threads, results):
+    """
+    crawlOne(crawler, threads, results): Run one crawler (in its own process) and put
+                                         (name, dlFiles, dlFilesBeta, error, ok, skipped) on results
+    """
+    name  = crawler.__class__.__name__
+    error = None
+    ok    = False
+    try:
+        logging.debug('Crawling {0} with {1} threads'.format(name, threads))
+        crawler.crawl(threads)
+        ok = True
+    except crawler.sourceErrors as e:
+        error = getErrorMessage(crawler, e)
+        logging.info(error)
+    except Exception:
+        logging.exception('!!! {0} failed'.format(name))
+    logging.info('{0} {1}'.format(name, crawler.report.getNeededCacheStats()))
+    results.put((name, crawler.dlFiles, crawler.dlFilesBeta, error, ok, crawler.skipped))
+# END: def crawlOne
+
+
+def crawlConcurrently(crawlers, workers):
+    """
+    crawlConcurrently(crawlers, workers): Run the crawlers at the same time, each in its own process
+                                          with its own number of threads (see allSources), while
+                                          all running crawlers together use at most workers threads
+                                          Returns (name, dlFiles, dlFilesBeta, error, ok, skipped, seconds)
+                                          per crawler, in the order of crawlers; seconds is None for a
+                                          crawler that was not started
+    """
+    results  = multiprocessing.Queue()
+    waiting  = list(crawlers)
+    running  = {}  # name: (process, threads, start)
+    finished = {}
+
+    while waiting or running:
+        # Running crawlers skip their remaining checks by themselves, waiting ones are not started
+        if waiting and crawlers[0].report.isSatisfied():
+            for crawler in waiting:
+                logging.info('All needed APKs found, skipping {0}'.format(crawler.__class__.__name__))
+                finished[crawler.__class__.__name__] = (crawler.__class__.__name__, [], [], None, True, [], None)
+            waiting = []
+
+        # Nor when the crawl budget is spent
+        if waiting and getRemaining() == 0.0:
+            for crawler in waiting:
+                logging.warning('Crawl budget spent, skipping {0}'.format(crawler.__class__.__name__))
+                finished[crawler.__class__.__name__] = (crawler.__class__.__name__, [], [], None, True, list(crawler.report.getAllApkIds()), None)
+            waiting = []
+
+        # Start every waiting crawler that fits in the remaining budget
+        free = workers - sum(threads for (process, threads, start) in running.values())
+        for crawler in list(waiting):
+            threads = min(crawler.sourceThreads, workers)
+            if threads <= free:
+                name    = crawler.__class__.__name__
+                process = multiprocessing.Process(target=crawlOne, args=(crawler, threads, results), name=name)
+                process.start()
+                logging.info('Started {0} with {1} threads ({2} of {3} workers free)'.format(name, threads, free - threads, workers))
+                running[name] = (process, threads, time.perf_counter())
+                waiting.remove(crawler)
+                free -= threads
+
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            # A crawler that crashed never reports back; don't wait for it
+            for (name, (process, threads, start)) in list(running.items()):
+                if process.exitcode not in [None, 0]:
+                    logging.error('!!! {0} died with exit code {1}'.format(name, process.exitcode))
+                    process.join()
+                    finished[name] = (name, [], [], None, False, [], time.perf_counter() - start)
+                    del running[name]
+            continue
+
+        (process, threads, start) = running.pop(result[0])
+        process.join()
+        finished[result[0]] = result + (time.perf_counter() - start,)
+        logging.info('Finished {0}: {1} files, {2} beta files'.format(result[0], len(result[1]), len(result[2])))
+    # END: while waiting or running
+
+    return [finished[crawler.__class__.__name__] for crawler in crawlers]
+# END: def crawlConcurrently
+
+
+def raceOne(crawler, apkid, results):
+    """
+    raceOne(crawler, apkid, results): Check one APK with one crawler (in its own process) and put
+                                      (name, filenames) on results
+    """
+    name = crawler.__class__.__name__
+    watchCancel('{0}.{1}'.format(name, apkid))
+    try:
+        result = crawler.checkOneApp(apkid)
+    except Exception:
+        logging.exception('!!! {0} failed checking {1}'.format(name, apkid))
+        result = None
+    if not isinstance(result, list):  # ApkMirror returns a list, the others one filename
+        result = [result]
+    results.put((name, [filename for filename in result if filename]))
+# END: def raceOne
+
+
+def raceApk(crawlers, apkid):
+    """
+    raceApk(crawlers, apkid): Check one APK with the crawlers at the same time; the first crawler that
+                              downloads something wins and the others are cancelled: they claim
+                              nothing more and stop their downloads in progress (see claimhelper)
+                              Returns (winner, filenames), winner is None if none found anything;
+                              filenames also has what the others finished before they stopped
+    """
+    results = multiprocessing.Queue()
+    running = {}
+    for crawler in crawlers:
+        name    = crawler.__class__.__name__
+        process = multiprocessing.Process(target=raceOne, args=(crawler, apkid, results), name=name)
+        process.start()
+        running[name] = process
+    logging.info('Racing {0} for {1}'.format(' and '.join(running.keys()), apkid))
+
+    (winner, filenames) = (None, [])
+    stop = None  # time.perf_counter() after which the cancelled crawlers are killed
+    while running and (stop is None or time.perf_counter() < stop):
+        try:
+            (name, found) = results.get(timeout=1)
+        except queue.Empty:
+            for (name, process) in list(running.items()):
+                if process.exitcode not in [None, 0]:
+                    process.join()
+                    del running[name]
+            continue
+
+        running.pop(name).join()
+        filenames.extend(found)
+        if found and winner is None:
+            winner = name
+            for loser in running:
+                logging.info('Cancelling {0} for {1}, {2} was first'.format(loser, apkid, winner))
+                cancelCrawl('{0}.{1}'.format(loser, apkid))
+            stop = time.perf_counter() + raceGrace
+    # END: while running
+
+    # Last resort for a crawler that is stuck in a request; clean up after it
+    for (name, process) in running.items():
+        logging.warning('Killing {0} for {1}, it did not stop within {2} seconds'.format(name, apkid, raceGrace))
+        process.terminate()
+        process.join()
+        abandonProcess(process.pid)
+    return (winner, filenames)
+# END: def raceApk
+
 if __name__ == "__main__":
     """
     main(): single parameter for report_sources.sh output
@@ -31,14 +241,41 @@ if __name__ == "__main__":
     logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    lines = ''
-    if len(sys.argv[1:]) == 1:
-        with open(sys.argv[1]) as report:
-            lines = report.readlines()
-    else:
-        lines = sys.stdin.readlines()
+    parser = argparse.ArgumentParser(description='Crawl all sources for the APKs that the report needs')
+    parser.add_argument('report', nargs='?',
+                        help='report file from output of report_sources.sh (or NDJSON) or the Open GApps sources directory; default: stdin')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='crawl all sources at the same time instead of one after another')
+    parser.add_argument('--workers', type=positiveInt, default=20,
+                        help='with --concurrent: maximum number of threads of all sources together (default: %(default)s)')
+    parser.add_argument('--stop-when-satisfied', action='store_true',
+                        help='stop as soon as all outdated APKs of the report are downloaded, instead of also looking for newer versions')
+    parser.add_argument('--race', action='append', default=[], metavar='APKID',
+                        help='before the run, let the two historically fastest sources race for this APK (can be repeated)')
+    parser.add_argument('--stream', action='store_true',
+                        help='write each downloaded file to stdout as soon as it is verified, one per line')
+    parser.add_argument('--stream-to', metavar='PATH',
+                        help='like --stream, but write to PATH (a file or FIFO) instead of stdout')
+    parser.add_argument('--stream-json', action='store_true',
+                        help='with --stream or --stream-to: write NDJSON lines with the metadata of each download')
+    parser.add_argument('--budget', type=float, metavar='SECONDS',
+                        help='end the crawl after SECONDS, cancelling what is still outstanding and reporting what was skipped')
+    parser.add_argument('--sources', default=','.join(allSources), metavar='NAME[,NAME...]',
+                        help='comma separated sources to crawl, out of: %(default)s (default: all)')
+    args = parser.parse_args()
 
-    report = ReportHelper(lines)
+    sources = [name.strip() for name in args.sources.split(',') if name.strip()]
+    unknown = [name for name in sources if name not in allSources]
+    if unknown or not sources:
+        parser.error('unknown source(s): {0}; choose from: {1}'.format(', '.join(unknown) or '(none)', ', '.join(allSources)))
+
+    if args.report and os.path.isdir(args.report):
+        report = buildReport(args.report)
+    elif args.report:
+        with open(args.report) as lines:
+            report = loadReport(lines)
+    else:
+        report = loadReport(sys.stdin)
 
     keys = list(report.getAllApkIds())
 
@@ -46,42 +283,98 @@ if __name__ == "__main__":
         print('ERROR: expecting:')
         print(' - 1 parameter (report file from output of report_sources.sh)')
         print(' or ')
+        print(' - 1 parameter (Open GApps sources directory)')
+        print(' or ')
         print(' - stdin from report_sources.sh')
         exit(1)
 
+    report.stopWhenSatisfied = args.stop_when_satisfied
+
+    if args.stream_to:
+        startStream(args.stream_to, args.stream_json)
+    elif args.stream:
+        startStream('-', args.stream_json)
+
+    if args.budget:
+        startBudget(args.budget)
+
     nonbeta = []
     beta    = []
+    skipped = {}  # name: apkids (or Aptoide IDs) not checked within the crawl budget
 
-    crawlers = [ApkBeastCrawler(report),
-                ApkdlCrawler(report),
-                ApkMirrorCrawler(report),
-                ApkPureCrawler(report),
-                AptoideCrawler(report),
-                MobogenieCrawler(report),
-                PlayStoreCrawler(report),
-                PlazzaCrawler(report),
-                UptodownCrawler(report)]
+    history  = loadHistory()
+    crawlers = loadSources(sources, report)
 
-    for crawler in crawlers:
-        try:
-            logging.debug('Crawling {0}'.format(crawler.__class__.__name__))
-            crawler.crawl()
-        except AptoideStoresException as e:
-            pass
-            logging.info('AptoideStoresException {0}'.format(e))
-            print('AptoideStoresException: {0}'.format(e))
-        except PlayStoreCredentialsException as e:
-            pass
-            logging.info('PlayStoreCredentialsException {0}'.format(e))
-            print('PlayStoreCredentialsException: {0}'.format(e))
-        nonbeta.extend(crawler.dlFiles)
-        beta.extend(crawler.dlFilesBeta)
+    # Historically fastest and most reliable sources first
+    crawlers.sort(key=lambda crawler: getScore(history, crawler.__class__.__name__))
+    logging.info('Source order: {0}'.format(', '.join(crawler.__class__.__name__ for crawler in crawlers)))
+
+    with claimRun():
+        for apkid in collections.OrderedDict.fromkeys(args.race):  # Each APK once
+            if apkid not in report.dAllApks:
+                logging.error('Not racing {0}, it is not in the report'.format(apkid))
+                continue
+
+            (winner, filenames) = raceApk([crawler for crawler in crawlers if hasattr(crawler, 'checkOneApp')][:2], apkid)
+            for filename in filenames:
+                if filename.startswith('beta:'):
+                    filename = filename[5:]
+                    beta.append(filename)
+                else:
+                    nonbeta.append(filename)
+                report.recordDownloadedFile(filename)
+
+        if args.concurrent:
+            for (name, dlFiles, dlFilesBeta, error, ok, notChecked, seconds) in crawlConcurrently(crawlers, args.workers):
+                if error:
+                    print(error)
+                nonbeta.extend(dlFiles)
+                beta.extend(dlFilesBeta)
+                if notChecked:
+                    skipped[name] = notChecked
+                if seconds is not None:
+                    recordRun(history, name, seconds, len(keys), ok)
+        else:
+            for crawler in crawlers:
+                if report.isSatisfied():
+                    logging.info('All needed APKs found, skipping {0}'.format(crawler.__class__.__name__))
+                    continue
+                if getRemaining() == 0.0:
+                    logging.warning('Crawl budget spent, skipping {0}'.format(crawler.__class__.__name__))
+                    skipped[crawler.__class__.__name__] = list(report.getAllApkIds())
+                    continue
+                start = time.perf_counter()
+                ok    = False
+                try:
+                    logging.debug('Crawling {0}'.format(crawler.__class__.__name__))
+                    crawler.crawl(crawler.sourceThreads)
+                    ok = True
+                except crawler.sourceErrors as e:
+                    logging.info(getErrorMessage(crawler, e))
+                    print(getErrorMessage(crawler, e))
+                recordRun(history, crawler.__class__.__name__, time.perf_counter() - start, len(keys), ok)
+                nonbeta.extend(crawler.dlFiles)
+                beta.extend(crawler.dlFilesBeta)
+                if crawler.skipped:
+                    skipped[crawler.__class__.__name__] = crawler.skipped
+
+                # Let the next crawlers know what we already have
+                for filename in crawler.dlFiles + crawler.dlFilesBeta:
+                    report.recordDownloadedFile(filename)
+
+        logMetrics()  # Of all crawler processes of the run
 
     outputString = ' '.join(nonbeta)
     if beta:
         outputString += ' beta ' + ' '.join(beta)
 
-    if outputString:
+    if outputString and not isStreamingStdout():
         print(outputString)
         sys.stdout.flush()
+
+    # Not on stdout, which is for the downloaded files
+    for (name, notChecked) in sorted(skipped.items()):
+        print('{0}: crawl budget spent, skipped {1}: {2}'.format(name, len(notChecked), ' '.join(str(item) for item in notChecked)), file=sys.stderr)
+    saveHistory(history)
+    logging.info(report.getNeededCacheStats())
     logging.debug('Done ...')
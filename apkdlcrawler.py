@@ -12,14 +12,19 @@ import os
 import re
 import logging
 import multiprocessing
-import requests
 
 from bs4 import BeautifulSoup
 import unicodedata
 
 from debug import Debug
 from apkhelper import ApkVersionInfo
-from reporthelper import ReportHelper
+from claimhelper import claimDownload, claimRun, releaseDownload, saveDownload
+from httphelper import getSession, readChunk
+from retryhelper import logMetrics
+from timeouthelper import getTimeout, mapWithinBudget
+from streamhelper import isStreamingStdout, openStream, streamDownload
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, loadReport
 
 ###################
 # DEBUG VARS      #
@@ -48,6 +53,7 @@ class ApkdlCrawler(object):
         self.report      = report
         self.dlFiles     = dlFiles
         self.dlFilesBeta = dlFilesBeta
+        self.skipped     = []  # What was not checked within the crawl budget, see mapWithinBudget()
 
     def getUrlFromRedirect(self, apkname, url):
         """
@@ -55,9 +61,9 @@ class ApkdlCrawler(object):
         """
         link      = ''
 
-        session = requests.Session()
+        session = getSession(url, self.__class__.__name__)
         logging.debug('Requesting2: ' + url)
-        resp    = session.get(url)
+        resp    = session.get(url, timeout=getTimeout('detail'))
         html    = unicodedata.normalize('NFKD', resp.text).encode('ascii', 'ignore')
 
         try:
@@ -95,16 +101,23 @@ class ApkdlCrawler(object):
                 logging.info('{0} already exists (in ../apkcrawler/)'.format(apkname))
                 return
 
+            if not claimDownload(apkInfo):
+                return
+
             # Open the url
-            session = requests.Session()
-            r = session.get(url)
+            session = getSession(url, self.__class__.__name__)
+            r = session.get(url, stream=True, timeout=getTimeout('download'))
 
-            with open(apkname, 'wb') as local_file:
-                local_file.write(r.content)
+            if not saveDownload(apkname, r.iter_content(readChunk)):
+                releaseDownload(apkInfo)
+                return
 
+            self.report.recordDownload(apkInfo)
+            streamDownload(apkname, apkInfo, isBeta)
             logging.debug(('beta:' if isBeta else 'reg :') + apkname)
             return       (('beta:' if isBeta else ''     ) + apkname)
         except OSError:
+            releaseDownload(apkInfo)
             logging.exception('!!! Filename is not valid: "{0}"'.format(apkname))
     # END: def downloadApk
 
@@ -118,9 +131,9 @@ class ApkdlCrawler(object):
 
         url       = 'http://apk-dl.com/' + apkid
 
-        session = requests.Session()
+        session = getSession(url, self.__class__.__name__)
         logging.debug('Requesting: ' + url)
-        resp    = session.get(url)
+        resp    = session.get(url, timeout=getTimeout('listing'))
         html    = unicodedata.normalize('NFKD', resp.text).encode('ascii', 'ignore')
 
         try:
@@ -128,6 +141,7 @@ class ApkdlCrawler(object):
             apklist = dom.findAll('ul', {'class': 'apks dlist'})[0]
             apks    = apklist.findAll('div', {'class': 'details'})
 
+            avis = []
             for apk in apks:
                 items = apk.findAll('div')
                 dApk = {}
@@ -157,9 +171,15 @@ class ApkdlCrawler(object):
                                              download_src=dApk['url'],
                                              crawler_name=self.__class__.__name__
                                              )
+                        avis.append(avi)
+            # END: for apk in apks:
 
-                        if self.report.isThisApkNeeded(avi):
-                            filenames.append(self.downloadApk(avi))
+            # Determine which versions to download
+            (needed, rejected) = self.report.filterNeeded(avis)
+            for (avi, reason) in rejected:
+                logging.debug('Skipping: "{0}" ({1}): {2}'.format(avi.name, avi.vercode, reason))
+            for avi in needed:
+                filenames.append(self.downloadApk(avi))
 
         except IndexError:
             logging.info('{0} not supported by apk-dl.com ...'.format(apkid))
@@ -174,15 +194,16 @@ class ApkdlCrawler(object):
         crawl(): check all apk-dl apps
         """
         # Start checking all apkids ...
-        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5)  # Run only 5 tasks before re-placing the process
-        r = p.map_async(unwrap_self_checkOneApp, list(zip([self] * len(list(self.report.getAllApkIds())), list(self.report.getAllApkIds()))), callback=unwrap_callback)
-        r.wait()
+        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5, initializer=unwrap_init, initargs=(self,))  # Run only 5 tasks before re-placing the process
+        (results, self.skipped) = mapWithinBudget(p, unwrap_self_checkOneApp, list(self.report.getAllApkIds()), self.__class__.__name__)
+        unwrap_callback(results)
         (self.dlFiles, self.dlFilesBeta) = unwrap_getresults()
     # END: crawl():
 # END: class ApkdlCrawler
 
 nonbeta = []
 beta    = []
+worker  = None  # the crawler in a pool process, see unwrap_init()
 
 
 def unwrap_callback(results):
@@ -199,8 +220,15 @@ def unwrap_getresults():
     return (nonbeta, beta)
 
 
-def unwrap_self_checkOneApp(arg, **kwarg):
-    return ApkdlCrawler.checkOneApp(*arg, **kwarg)
+def unwrap_init(crawler):
+    global worker
+    worker = crawler
+
+
+def unwrap_self_checkOneApp(arg):
+    if worker.report.isSatisfied():  # Nothing left to find
+        return None
+    return worker.checkOneApp(arg)
 
 
 if __name__ == "__main__":
@@ -210,30 +238,34 @@ if __name__ == "__main__":
     logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    lines = ''
-    if len(sys.argv[1:]) == 1:
-        with open(sys.argv[1]) as report:
-            lines = report.readlines()
+    if len(sys.argv[1:]) == 1 and os.path.isdir(sys.argv[1]):
+        report = buildReport(sys.argv[1])
+    elif len(sys.argv[1:]) == 1:
+        with open(sys.argv[1]) as lines:
+            report = loadReport(lines)
     else:
-        lines = sys.stdin.readlines()
-
-    report = ReportHelper(lines)
+        report = loadReport(sys.stdin)
 
     if len(list(report.getAllApkIds())) == 0:
         print('ERROR: expecting:')
         print(' - 1 parameter (report file from output of report_sources.sh)')
         print(' or ')
+        print(' - 1 parameter (Open GApps sources directory)')
+        print(' or ')
         print(' - stdin from report_sources.sh')
         exit(1)
 
     crawler = ApkdlCrawler(report)
-    crawler.crawl()
+    openStream()  # Before the pool forks, so all its workers share the stream
+    with claimRun():
+        crawler.crawl()
+        logMetrics()
 
     outputString = ' '.join(crawler.dlFiles)
     if crawler.dlFilesBeta:
         outputString += ' beta ' + ' '.join(crawler.dlFilesBeta)
 
-    if outputString:
+    if outputString and not isStreamingStdout():
         print(outputString)
         sys.stdout.flush()
 
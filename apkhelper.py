@@ -1,62 +1,145 @@
 from functools import total_ordering
+import json
 import logging
+import os
 import re
+import sys
+
+###################
+# Version rules   #
+###################
+# Per package rules, keyed by exact package name:
+#  verParts   - only the first N parts of the version name are compared
+#  perRealver - 'oneVariant': there is only one variant per realver, so having the realver
+#                             or an equal/higher vercode is enough
+#               'oneVercode': there is only one vercode per realver, so having the realver is enough
+# Additional or overriding rules can be put in apkhelper.config (same layout, as JSON)
+defaultVersionRules = {
+    'com.google.android.apps.books'              : {'perRealver': 'oneVariant'},
+    'com.google.android.apps.classroom'          : {'verParts': 4},
+    'com.google.android.apps.docs'               : {'verParts': 4, 'perRealver': 'oneVercode'},
+    'com.google.android.apps.docs.editors.docs'  : {'verParts': 4, 'perRealver': 'oneVercode'},
+    'com.google.android.apps.docs.editors.sheets': {'verParts': 4, 'perRealver': 'oneVercode'},
+    'com.google.android.apps.docs.editors.slides': {'verParts': 4, 'perRealver': 'oneVercode'},
+    'com.google.android.apps.enterprise.dmagent' : {'perRealver': 'oneVariant'},
+    'com.google.android.apps.fitness'            : {'perRealver': 'oneVercode'},
+    'com.google.android.apps.gcs'                : {'perRealver': 'oneVariant'},
+    'com.google.android.apps.genie.geniewidget'  : {'perRealver': 'oneVariant'},
+    'com.google.android.apps.inputmethod.hindi'  : {'perRealver': 'oneVercode'},
+    'com.google.android.apps.inputmethod.zhuyin' : {'perRealver': 'oneVercode'},
+    'com.google.android.apps.messaging'          : {'perRealver': 'oneVercode'},
+    'com.google.android.apps.pdfviewer'          : {'verParts': 4},
+    'com.google.android.apps.pixelmigrate'       : {'perRealver': 'oneVariant'},
+    'com.google.android.apps.turbo'              : {'perRealver': 'oneVariant'},
+    'com.google.android.apps.tv.launcherx'       : {'perRealver': 'oneVariant'},
+    'com.google.android.apps.tycho'              : {'perRealver': 'oneVercode'},
+    'com.google.android.as'                      : {'perRealver': 'oneVariant'},
+    'com.google.android.calculator'              : {'perRealver': 'oneVariant'},
+    'com.google.android.calendar'                : {'perRealver': 'oneVariant'},
+    'com.google.android.deskclock'               : {'perRealver': 'oneVariant'},
+    'com.google.android.ears'                    : {'perRealver': 'oneVariant'},
+    'com.google.android.gm'                      : {'perRealver': 'oneVariant'},
+    'com.google.android.gm.exchange'             : {'perRealver': 'oneVariant'},
+    'com.google.android.gms'                     : {'perRealver': 'oneVercode'},
+    'com.google.android.googlecamera'            : {'perRealver': 'oneVercode'},
+    'com.google.android.googlequicksearchbox'    : {'verParts': 3, 'perRealver': 'oneVercode'},
+    'com.google.android.inputmethod.japanese'    : {'perRealver': 'oneVercode'},
+    'com.google.android.inputmethod.korean'      : {'perRealver': 'oneVercode'},
+    'com.google.android.inputmethod.latin'       : {'perRealver': 'oneVercode'},
+    'com.google.android.inputmethod.pinyin'      : {'perRealver': 'oneVercode'},
+    'com.google.android.keep'                    : {'verParts': 4, 'perRealver': 'oneVercode'},
+    'com.google.android.marvin.talkback'         : {'perRealver': 'oneVariant'},
+    'com.google.android.music'                   : {'perRealver': 'oneVariant'},
+    'com.google.android.play.games'              : {'perRealver': 'oneVercode'},
+    'com.google.android.projection.gearhead'     : {'verParts': 2, 'perRealver': 'oneVercode'},
+    'com.google.android.tv'                      : {'perRealver': 'oneVercode'},
+    'com.google.android.tv.remote'               : {'perRealver': 'oneVariant'}}
+
+versionRules = {}  # name: (verParts, perRealver), see compileVersionRules()
+
+
+def compileVersionRules(rules):
+    """
+    compileVersionRules(rules): Add rules to the versionRules lookup table
+                                The .beta package of a rule shares its version truncation,
+                                but (like before) not its perRealver rule
+                                Raises ValueError for a malformed rule, leaving the table as it was
+    """
+    if not isinstance(rules, dict):
+        raise ValueError('Expecting rules by package name, not: {0}'.format(rules))
+
+    compiled = {}
+    for name, rule in rules.items():
+        if not isinstance(rule, dict):
+            raise ValueError('Expecting a rule for {0}, not: {1}'.format(name, rule))
+
+        verParts   = rule.get('verParts')
+        perRealver = rule.get('perRealver')
+        if verParts is not None and (not isinstance(verParts, int) or verParts < 1):
+            raise ValueError('Invalid verParts rule "{0}" for {1}'.format(verParts, name))
+        if perRealver not in [None, 'oneVariant', 'oneVercode']:
+            raise ValueError('Unknown perRealver rule "{0}" for {1}'.format(perRealver, name))
+
+        compiled[name] = (verParts, perRealver)
+        if verParts and name + '.beta' not in rules:
+            compiled[name + '.beta'] = (verParts, None)
+    versionRules.update(compiled)
+# END: def compileVersionRules
+
+
+def loadVersionRules(file_name):
+    """
+    loadVersionRules(file_name): Add the rules from a JSON file to the versionRules lookup table
+                                 Raises OSError or ValueError if the file is unreadable or malformed
+    """
+    with open(file_name, 'r') as rules_file:
+        compileVersionRules(json.load(rules_file))
+# END: def loadVersionRules
+
+compileVersionRules(defaultVersionRules)
+
+# A broken config must not take down every crawler that imports this
+rulesfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'apkhelper.config')
+if os.path.isfile(rulesfile):
+    try:
+        loadVersionRules(rulesfile)
+    except (OSError, ValueError):
+        logging.exception('!!! Ignoring invalid "{0}", using the default version rules'.format(rulesfile))
+
+reVerAlpha = re.compile('[A-Za-z]+')
+reName     = re.compile('^(?P<name>.*)(?P<extra>\.(leanback|beta|stub|vrmode|default|tablet|watch))$')
+reVer      = re.compile('^(?P<ver>[^(\s-]*)(?P<extra>([(\s-].*|(\.(arm|arm\.arm_neon|arm64|x86|large|small|storeRelease))))$')  # .release?
+
+
+def verKey(ver):
+    """
+    verKey(ver): Convert a version string into a tuple that sorts numerically
+                 Blanks become 0, '-' and '_' act like '.', letters are dropped and
+                 trailing zeros are stripped, so '1.2' and '1.2.0' get the same key
+    """
+    key = [int(x if x != '' else '0') for x in reVerAlpha.sub('', ver.replace('-', '.').replace('_', '.')).split('.')]
+    while key and key[-1] == 0:
+        key.pop()
+    return tuple(key)
+# END: def verKey
 
-oneVariantPerRealver = {'com.google.android.apps.books',
-                        'com.google.android.apps.enterprise.dmagent',
-                        'com.google.android.apps.gcs',
-                        'com.google.android.apps.genie.geniewidget',
-                        'com.google.android.apps.pixelmigrate',
-                        'com.google.android.apps.turbo',
-                        'com.google.android.apps.tv.launcherx',
-                        'com.google.android.as',
-                        'com.google.android.calculator',
-                        'com.google.android.calendar',
-                        'com.google.android.deskclock',
-                        'com.google.android.ears',
-                        'com.google.android.gm',
-                        'com.google.android.gm.exchange',
-                        'com.google.android.marvin.talkback',
-                        'com.google.android.music',
-                        'com.google.android.tv.remote'}
-
-oneVercodePerRealver = {'com.google.android.apps.docs',
-                        'com.google.android.apps.docs.editors.docs',
-                        'com.google.android.apps.docs.editors.sheets',
-                        'com.google.android.apps.docs.editors.slides',
-                        'com.google.android.apps.fitness',
-                        'com.google.android.apps.inputmethod.hindi',
-                        'com.google.android.apps.inputmethod.zhuyin',
-                        'com.google.android.apps.messaging',
-                        'com.google.android.apps.tycho',
-                        'com.google.android.gms',
-                        'com.google.android.googlecamera',
-                        'com.google.android.googlequicksearchbox',
-                        'com.google.android.inputmethod.japanese',
-                        'com.google.android.inputmethod.korean',
-                        'com.google.android.inputmethod.latin',
-                        'com.google.android.inputmethod.pinyin',
-                        'com.google.android.keep',
-                        'com.google.android.play.games',
-                        'com.google.android.projection.gearhead',
-                        'com.google.android.tv'}
 
 @total_ordering
 class ApkVersionInfo(object):
     """ApkVersionInfo"""
+    # A report holds thousands of these, so keep them small: no per-instance __dict__
+    # and interned name/arch/dpi strings, which repeat across all rows of a package
+    __slots__ = ('name', 'lowername', 'extraname', 'arch', 'sdk', 'target', 'dpi',
+                 'ver', 'realver', 'vercode', 'scrape_src', 'download_src', 'crawler_name',
+                 'malware', '_verKey', '_verKeySrc')
+
     def __init__(self, name='', arch='', sdk='', target='', dpi='', ver='', vercode='', scrape_src='', download_src='', crawler_name='unknown', malware=''):
         super(ApkVersionInfo, self).__init__()
 
-        sName  = '^(?P<name>.*)(?P<extra>\.(leanback|beta|stub|vrmode|default|tablet|watch))$'
-        reName = re.compile(sName)
-
-        sVer   = '^(?P<ver>[^(\s-]*)(?P<extra>([(\s-].*|(\.(arm|arm\.arm_neon|arm64|x86|large|small|storeRelease))))$'  # .release?
-        reVer  = re.compile(sVer)
-
         self.name         = name
-        self.lowername    = name.lower()
+        self.lowername    = sys.intern(name.lower())
         self.extraname    = None  # used for beta/leanback versions
-        self.arch         = arch
+        self.arch         = sys.intern(arch)
         self.sdk          = 0 if sdk == '' else sdk
         try:
             self.sdk      = int(self.sdk)
@@ -67,7 +150,7 @@ class ApkVersionInfo(object):
             self.target      = int(self.target)
         except:
             pass
-        self.dpi          = dpi
+        self.dpi          = sys.intern(dpi)
         self.ver          = ver   # used for comparing (could be shortened later)
         self.realver      = ver   # used for full/original versions
         self.vercode      = 0 if vercode == '' else int(vercode)
@@ -77,6 +160,9 @@ class ApkVersionInfo(object):
         self.crawler_name = crawler_name
         self.malware = malware
 
+        self._verKey    = None  # cached verKey(self.ver), see getVerKey()
+        self._verKeySrc = None
+
         m = reName.match(self.name)
         if m:
             self.extraname = self.name
@@ -85,22 +171,15 @@ class ApkVersionInfo(object):
             # Let's keep .beta its own package for now
             if m.group('extra') == '.beta':
                 self.name = self.extraname
+        self.name = sys.intern(self.name)
 
         m = reVer.match(self.ver)
         if m:
             self.ver = m.group('ver')
 
-        if ('com.google.android.projection.gearhead' in self.name):
-            self.ver = '.'.join(self.ver.split('.')[0:2])
-
-        if ('com.google.android.googlequicksearchbox' in self.name):
-            self.ver = '.'.join(self.ver.split('.')[0:3])
- 
-        if ('com.google.android.apps.classroom' in self.name or
-            'com.google.android.apps.docs'      in self.name or
-            'com.google.android.apps.pdfviewer' in self.name or
-            'com.google.android.keep'           in self.name):
-            self.ver = '.'.join(self.ver.split('.')[0:4])
+        rule = versionRules.get(self.name)
+        if rule and rule[0]:
+            self.ver = '.'.join(self.ver.split('.')[0:rule[0]])
     # END: def init
 
     def fullString(self, max):
@@ -121,10 +200,32 @@ class ApkVersionInfo(object):
     # END: def getFilename
 
     def isRealverAbsolute(self):
-        return (self.name in oneVariantPerRealver) or (self.name in oneVercodePerRealver)
+        rule = versionRules.get(self.name)
+        return rule is not None and rule[1] is not None
 
     def isVercodeAbsolute(self):
-        return (self.name in oneVariantPerRealver)
+        rule = versionRules.get(self.name)
+        return rule is not None and rule[1] == 'oneVariant'
+
+    def getVerKey(self):
+        """
+        getVerKey(): Return the numeric sort key of ver, computed once and reused
+                     for every comparison as long as ver is unchanged
+        """
+        if self._verKeySrc is not self.ver:
+            self._verKey    = verKey(self.ver)
+            self._verKeySrc = self.ver
+        return self._verKey
+    # END: def getVerKey
+
+    def getFullVerKey(self):
+        """
+        getFullVerKey(): Return the numeric sort key of the full version (realver), i.e. without
+                         the truncation of its verParts rule, which ver (see getVerKey) has
+        """
+        m = reVer.match(self.realver)
+        return verKey(m.group('ver') if m else self.realver)
+    # END: def getFullVerKey
 
     def __lt__(self, other):
         if self.ver == '':
@@ -134,23 +235,7 @@ class ApkVersionInfo(object):
             logging.error('AVI.cmp(): other.ver is empty [{0}]'.format(other.ver))
             return NotImplemented
         else:
-
-            # Make blank-->'0', replace - and _ with . and split into parts
-            ps = [int(x if x != '' else '0') for x in re.sub('[A-Za-z]+', '', self.ver.replace('-', '.').replace('_', '.')).split('.')]
-            po = [int(x if x != '' else '0') for x in re.sub('[A-Za-z]+', '', other.ver.replace('-', '.').replace('_', '.')).split('.')]
-
-            # fill up the shorter version with zeros ...
-            lendiff = len(ps) - len(po)
-            if lendiff > 0:
-                po.extend([0] * lendiff)
-            elif lendiff < 0:
-                ps.extend([0] * (-lendiff))
-
-            for i, p in enumerate(ps):
-                if p != po[i]:
-                    return p < po[i]
-
-            return ps < po
+            return self.getVerKey() < other.getVerKey()
     # END: def __lt__
 
     def __eq__(self, other):
@@ -161,22 +246,18 @@ class ApkVersionInfo(object):
             logging.error('AVI.cmp(): other.ver is empty [{0}]'.format(other.ver))
             return NotImplemented
         else:
-            import re
-
-            # Make blank-->'0', replace - and _ with . and split into parts
-            ps = [int(x if x != '' else '0') for x in re.sub('[A-Za-z]+', '', self.ver.replace('-', '.').replace('_', '.')).split('.')]
-            po = [int(x if x != '' else '0') for x in re.sub('[A-Za-z]+', '', other.ver.replace('-', '.').replace('_', '.')).split('.')]
+            return self.getVerKey() == other.getVerKey()
+    # END: def __eq__
 
-            # fill up the shorter version with zeros ...
-            lendiff = len(ps) - len(po)
-            if lendiff > 0:
-                po.extend([0] * lendiff)
-            elif lendiff < 0:
-                ps.extend([0] * (-lendiff))
+    def __getstate__(self):
+        # A plain tuple pickles and unpickles much faster than the default slots state
+        return tuple(getattr(self, slot) for slot in self.__slots__)
 
-            return ps == (po)
-    # END: def __eq__
+    def __setstate__(self, state):
+        (self.name, self.lowername, self.extraname, self.arch, self.sdk, self.target, self.dpi,
+         self.ver, self.realver, self.vercode, self.scrape_src, self.download_src, self.crawler_name,
+         self.malware, self._verKey, self._verKeySrc) = state
 
     def __str__(self):
-        return str(self.__dict__)
+        return str({slot: getattr(self, slot) for slot in self.__slots__})
 # END: class ApkVersionInfo
@@ -12,14 +12,19 @@ import os
 import re
 import logging
 import multiprocessing
-import requests
 
 from bs4 import BeautifulSoup
 import unicodedata
 
 from debug import Debug
 from apkhelper import ApkVersionInfo
-from reporthelper import ReportHelper
+from claimhelper import claimDownload, claimRun, releaseDownload, saveDownload
+from httphelper import getSession, readChunk
+from retryhelper import logMetrics
+from timeouthelper import getTimeout, mapWithinBudget
+from streamhelper import isStreamingStdout, openStream, streamDownload
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, loadReport
 
 ###################
 # DEBUG VARS      #
@@ -139,11 +144,42 @@ allApkMirrorNames = {
     'com.google.vr.vrcore'                          : 'google-vr-services'}
 
 
+# Variant table values of ApkMirror as they are named in the report
+# Anything else (e.g. multiple archs or dpi ranges) is left as is and so never matches the report
+allApkMirrorArchs = {
+    'arm64-v8a'  : 'arm64',
+    'armeabi'    : 'arm',
+    'armeabi-v7a': 'arm',
+    'noarch'     : 'all',
+    'x86'        : 'x86',
+    'x86_64'     : 'x86_64'}
+
+allApkMirrorSdks = {
+    '4.4' : 19,
+    '4.4W': 20,
+    '5.0' : 21,
+    '5.1' : 22,
+    '6.0' : 23,
+    '7.0' : 24,
+    '7.1' : 25,
+    '8.0' : 26,
+    '8.1' : 27,
+    '9'   : 28,
+    '9.0' : 28,
+    '10'  : 29,
+    '11'  : 30,
+    '12'  : 31,
+    '12L' : 32,
+    '13'  : 33,
+    '14'  : 34}
+
+
 class ApkMirrorCrawler(object):
     def __init__(self, report, dlFiles=[], dlFilesBeta=[]):
         self.report      = report
         self.dlFiles     = dlFiles
         self.dlFilesBeta = dlFilesBeta
+        self.skipped     = []  # What was not checked within the crawl budget, see mapWithinBudget()
 
         self.sReVerInfo = 'Version:\s(?P<VERNAME>.*)\s\((?P<VERCODE>\d*)[^)]*\)'
         self.reVersion  = re.compile(self.sReVerInfo)
@@ -154,6 +190,9 @@ class ApkMirrorCrawler(object):
         self.sReTargetInfo = 'Target:\s.*API\s(?P<Target>\w*)\)'
         self.reTarget      = re.compile(self.sReTargetInfo)
 
+        self.sReMinAndroid = 'Android\s(?P<VERSION>[^+\s]*)\+'
+        self.reMinAndroid  = re.compile(self.sReMinAndroid)
+
         self.headers     = {'User-Agent': 'OpenGApps APKMirrorCrawler/1.0'}
 
     def downloadApk(self, avi, isBeta=False):
@@ -178,17 +217,23 @@ class ApkMirrorCrawler(object):
                 logging.info('{0} already exists (in ../apkcrawler/)'.format(apkname))
                 return
 
+            if not claimDownload(avi):
+                return
+
             # Open the url
-            session = requests.Session()
-            session.headers.update(self.headers)
-            r = session.get(avi.download_src)
+            session = getSession(avi.download_src, self.__class__.__name__)
+            r = session.get(avi.download_src, headers=self.headers, stream=True, timeout=getTimeout('download'))
 
-            with open(apkname, 'wb') as local_file:
-                local_file.write(r.content)
+            if not saveDownload(apkname, r.iter_content(readChunk)):
+                releaseDownload(avi)
+                return
 
+            self.report.recordDownload(avi)
+            streamDownload(apkname, avi, isBeta)
             logging.debug(('beta:' if isBeta else 'reg :') + apkname)
             return (('beta:' if isBeta else '') + apkname)
         except OSError:
+            releaseDownload(avi)
             logging.exception('!!! Filename is not valid: "{0}"'.format(apkname))
     # END: def downloadApk(avi):
 
@@ -200,11 +245,10 @@ class ApkMirrorCrawler(object):
         try:
             url = 'https://www.apkmirror.com' + avi.scrape_src
 
-            session = requests.Session()
-            session.headers.update(self.headers)
+            session = getSession(url, self.__class__.__name__)
             logging.debug('Requesting3: ' + url)
 
-            resp    = session.get(url)
+            resp    = session.get(url, headers=self.headers, timeout=getTimeout('detail'))
             html    = unicodedata.normalize('NFKD', resp.text).encode('ascii', 'ignore')
 
             dom          = BeautifulSoup(html, 'html5lib')
@@ -221,7 +265,13 @@ class ApkMirrorCrawler(object):
 
                 cells = tr.findAll('div', {'class': 'table-cell'})
                 avi.scrape_src = cells[0].find('a')['href']
-                avi.arch = cells[1].get_text()
+                avi.arch = allApkMirrorArchs.get(cells[1].get_text().strip(), cells[1].get_text())
+
+                # Only open the variant's page if the report lacks this variant at this version
+                variant = self.getVariantInfo(avi, cells)
+                if not self.report.fillsVariantGap(variant):
+                    logging.debug('Skipping variant: "{0}" ({1}|{2}|{3}) already in report'.format(avi.scrape_src, variant.arch, variant.sdk, variant.dpi))
+                    continue
 
                 tmp = self.getOneVersionInfo(avi)
                 if tmp:
@@ -235,6 +285,29 @@ class ApkMirrorCrawler(object):
                 logging.exception('!!! Error parsing html from: "{0}"'.format(url))
     # END: def getMultipleVersionInfo(avi):
 
+    def getVariantInfo(self, avi, cells):
+        """
+        getVariantInfo(avi, cells): Determines the arch/sdk/dpi of a variant table row, as far as
+                                    known; unknown values are left empty
+        """
+        arch = cells[1].get_text().strip()
+        sdk  = ''
+        dpi  = ''
+        if len(cells) > 3:
+            m = self.reMinAndroid.search(cells[2].get_text())
+            if m:
+                sdk = allApkMirrorSdks.get(m.group('VERSION'), '')
+            dpi = cells[3].get_text().strip()
+            if dpi.endswith('dpi') and dpi != 'nodpi':
+                dpi = dpi[:-3]
+
+        return ApkVersionInfo(name=avi.name,
+                              arch=allApkMirrorArchs.get(arch, arch),
+                              sdk=sdk,
+                              dpi=dpi,
+                              ver=avi.realver)
+    # END: def getVariantInfo(avi, cells):
+
     def getOneVersionInfo(self, avi):
         """
         getOneVersionInfo(avi): Determines each versions information
@@ -242,11 +315,10 @@ class ApkMirrorCrawler(object):
         try:
             url = 'https://www.apkmirror.com' + avi.scrape_src
 
-            session = requests.Session()
-            session.headers.update(self.headers)
+            session = getSession(url, self.__class__.__name__)
             logging.debug('Requesting2: ' + url)
 
-            resp    = session.get(url)
+            resp    = session.get(url, headers=self.headers, timeout=getTimeout('detail'))
             html    = unicodedata.normalize('NFKD', resp.text).encode('ascii', 'ignore')
 
             dom         = BeautifulSoup(html, 'html5lib')
@@ -312,11 +384,10 @@ class ApkMirrorCrawler(object):
             # For now favor slow load and skip checking all versions (below)
             url = 'https://www.apkmirror.com/uploads/?q={0}'.format(apkMirrorName)
 
-            session = requests.Session()
-            session.headers.update(self.headers)
+            session = getSession(url, self.__class__.__name__)
             logging.debug('Requesting1: ' + url)
             try:
-                resp = session.get(url)
+                resp = session.get(url, headers=self.headers, timeout=getTimeout('listing'))
                 html = unicodedata.normalize('NFKD', resp.text).encode('ascii', 'ignore')
 
                 dom      = BeautifulSoup(html, 'html5lib')
@@ -356,13 +427,13 @@ class ApkMirrorCrawler(object):
                 # END: for version in versions:
 
                 # Determine which versions to download
-                for avi in avis:
-                    if self.report.isThisApkNeeded(avi):
-                        logging.info('Downloading: "{0}"'.format(avi.getFilename()))
-                        filenames.append(self.downloadApk(avi, avi.name.endswith('.beta')))
-                    else:
-                        logging.debug('Skipping: "{0}" ({1})'.format(avi.name, avi.scrape_src))
-                # END: for avi in avis:
+                (needed, rejected) = self.report.filterNeeded(avis)
+                for (avi, reason) in rejected:
+                    logging.debug('Skipping: "{0}" ({1}): {2}'.format(avi.name, avi.scrape_src, reason))
+                for avi in needed:
+                    logging.info('Downloading: "{0}"'.format(avi.getFilename()))
+                    filenames.append(self.downloadApk(avi, avi.name.endswith('.beta')))
+                # END: for avi in needed:
             except:
                 logging.exception('!!! Error parsing html from: "{0}"'.format(url))
         except KeyError:
@@ -376,17 +447,16 @@ class ApkMirrorCrawler(object):
         crawl(): check all ApkMirror apps
         """
         # Start checking all apkids ...
-        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5)  # Run only 5 tasks before re-placing the process
-        r = p.map_async(unwrap_self_checkOneApp,
-                        list(zip([self] * len(list(self.report.getAllApkIds())), list(self.report.getAllApkIds()))),
-                        callback=unwrap_callback)
-        r.wait()
+        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5, initializer=unwrap_init, initargs=(self,))  # Run only 5 tasks before re-placing the process
+        (results, self.skipped) = mapWithinBudget(p, unwrap_self_checkOneApp, list(self.report.getAllApkIds()), self.__class__.__name__)
+        unwrap_callback(results)
         (self.dlFiles, self.dlFilesBeta) = unwrap_getresults()
     # END: crawl():
 # END: class ApkMirrorCrawler
 
 nonbeta = []
 beta    = []
+worker  = None  # the crawler in a pool process, see unwrap_init()
 
 
 def unwrap_callback(results):
@@ -403,8 +473,15 @@ def unwrap_getresults():
     return (nonbeta, beta)
 
 
-def unwrap_self_checkOneApp(arg, **kwarg):
-    return ApkMirrorCrawler.checkOneApp(*arg, **kwarg)
+def unwrap_init(crawler):
+    global worker
+    worker = crawler
+
+
+def unwrap_self_checkOneApp(arg):
+    if worker.report.isSatisfied():  # Nothing left to find
+        return []
+    return worker.checkOneApp(arg)
 
 if __name__ == "__main__":
     """
@@ -413,30 +490,34 @@ if __name__ == "__main__":
     logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    lines = ''
-    if len(sys.argv[1:]) == 1:
-        with open(sys.argv[1]) as report:
-            lines = report.readlines()
+    if len(sys.argv[1:]) == 1 and os.path.isdir(sys.argv[1]):
+        report = buildReport(sys.argv[1])
+    elif len(sys.argv[1:]) == 1:
+        with open(sys.argv[1]) as lines:
+            report = loadReport(lines)
     else:
-        lines = sys.stdin.readlines()
-
-    report = ReportHelper(lines)
+        report = loadReport(sys.stdin)
 
     if len(list(report.getAllApkIds())) == 0:
         print('ERROR: expecting:')
         print(' - 1 parameter (report file from output of report_sources.sh)')
         print(' or ')
+        print(' - 1 parameter (Open GApps sources directory)')
+        print(' or ')
         print(' - stdin from report_sources.sh')
         exit(1)
 
     crawler = ApkMirrorCrawler(report)
-    crawler.crawl()
+    openStream()  # Before the pool forks, so all its workers share the stream
+    with claimRun():
+        crawler.crawl()
+        logMetrics()
 
     outputString = ' '.join(crawler.dlFiles)
     if crawler.dlFilesBeta:
         outputString += ' beta ' + ' '.join(crawler.dlFilesBeta)
 
-    if outputString:
+    if outputString and not isStreamingStdout():
         print(outputString)
         sys.stdout.flush()
 
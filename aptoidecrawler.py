@@ -7,19 +7,25 @@
 
 from datetime import datetime, timedelta
 import pytz
+import requests
 import http.client
 import json
 import logging
 import multiprocessing
 import os
-import requests
 import socket
 import sys
 import time
 
 from debug import Debug
 from apkhelper import ApkVersionInfo
-from reporthelper import ReportHelper
+from claimhelper import claimDownload, claimRun, releaseDownload, saveDownload
+from httphelper import getSession, readChunk
+from retryhelper import logMetrics
+from timeouthelper import getTimeout, mapWithinBudget
+from streamhelper import isStreamingStdout, openStream, streamDownload
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, loadReport
 
 from socket import error as socket_error
 
@@ -38,7 +44,6 @@ from socket import error as socket_error
 ###################
 # Globals         #
 ###################
-GlobalDelay = 1
 
 # logging
 logFile   = '{0}.log'.format(os.path.basename(__file__))
@@ -51,12 +56,13 @@ class AptoideCrawler(object):
         self.report      = report
         self.dlFiles     = dlFiles
         self.dlFilesBeta = dlFilesBeta
+        self.skipped     = []  # What was not checked within the crawl budget, see mapWithinBudget()
         self.runInfo     = runInfo
 
     def logIdAndDate(self, itemApk):
         if itemApk['package'] == 'org.opengapps.app':
             logging.info('*** HEY IT IS OPENGAPPS ON APTOIDE *** {0}|{1}|{2}'.format(itemApk['id'], itemApk['modified'], itemApk['package']))
-        elif itemApk['package'] not in list(self.report.dAllApks.keys()):
+        elif itemApk['package'] not in self.report.dAllApks:
             logging.debug('{0}|{1}|{2}'.format(itemApk['id'], itemApk['modified'], itemApk['package']))
         else:
             logging.info('{0}|{1}|{2}'.format(itemApk['id'], itemApk['modified'], itemApk['package']))
@@ -80,85 +86,85 @@ class AptoideCrawler(object):
         run['filename'] = ''
 
         if data == '':
-            session = requests.Session()
-
-            for x in range(1, 4):  # up to three tries
-                wait = GlobalDelay * x
-                # logging.info('Waiting {0} seconds before fetching {1}'.format(wait, file_name))
-                time.sleep(wait)
-                try:
-                    logging.debug('Checking ({0}): {1}'.format(x, url))
-                    resp = session.get(url)
-
-                    if resp.status_code == http.client.OK:
-                        # Append ID on good http response
-                        run['status'] = 'empty'
-
-                        data = resp.json()
-                        if 'info' in data and 'status' in data['info'] and data['info']['status'] == 'OK':
-                            # Found an APK update the Max. ID
-                            run['status'] = 'good'
-                            run['time']   = data['data']['modified']
-
-                            theArchs = data['data']['file']['hardware'].get('cpus', [])
-                            _arch = 'all'
-                            if len(theArchs) > 0:
-                                _arch = ','.join(theArchs)
-
-                            avi = ApkVersionInfo(name        =data['data']['package'],
-                                                 arch        =_arch,
-                                                 sdk         =data['data']['file']['hardware']['sdk'],
-                                                 dpi         =self.doDpiStuff(data['data']['file']['hardware'].get('densities', [])),
-                                                 ver         =data['data']['file']['vername'].split(' ')[0],  # Look at only the true version number
-                                                 vercode     =data['data']['file']['vercode'],
-                                                 download_src=data['data']['file']['path'],
-                                                 malware=(data['data']['file']['malware'] if 'malware' in data['data']['file'] else ''),  # We only have this key if vercode is in options
-                                                 crawler_name=self.__class__.__name__
-                                                 )
-
-                            Debug.writeToFile(file_name, json.dumps(data, sort_keys=True,
-                                              indent=4, separators=(',', ': ')), resp.encoding)
-
-                            # Log AptoideID, Date, ApkID
-                            self.logIdAndDate(data['data'])
-
-                            # Check for beta support
-                            bCheckMore = False
-                            if self.report.needsBetaSupport(avi):
-                                import copy
-                                avibeta = copy.deepcopy(avi)
-                                avibeta.name += '.beta'
-                                needBeta = self.report.isThisApkNeeded(avibeta)
-
-                            # Do we already have it
-                            if self.report.isThisApkNeeded(avi):
-                                if (avi.malware['rank'] == "warn" and
-                                    avi.malware['reason']['signature_validated']['status'] == "failed" and
-                                    avi.malware['reason']['signature_validated']['signature_from'] == "market"):  # signature matches market, but it does not pass verification
-                                    logging.error('{0} is a corrupt or incomplete APK, ignored.'.format(avi.download_src))
-                                else:
-                                    # Are we sure we still need it after the additional info?
-                                    if self.report.isThisApkNeeded(avi):
-                                        run['filename'] = self.downloadApk(avi)
-                                # END: if avi.malware
-
-                            if avi.name == 'org.opengapps.app':
-                                run['filename'] = '{0}-{1}_aptoideId-{2}.stub.apk'.format(avi.name, avi.vercode, aptoideId)
-                        else:
-                            pass  # logging.error('data2[\'status\']: {0}, when fetching {1}, try {2}'.format(data.get('status', 'null'), file_name, x))
-
-                        return run
-                    elif resp.status_code in [http.client.UNAUTHORIZED,  # 401
-                                              http.client.FORBIDDEN,     # 403
-                                              http.client.NOT_FOUND,     # 404
-                                              http.client.GONE]:         # 410
-                        run['status'] = 'empty'
-                        return run
+            session = getSession(url, self.__class__.__name__)
+
+            # Transient errors (429, 5xx, dropped connections) are retried by httphelper
+            try:
+                logging.debug('Checking: {0}'.format(url))
+                resp = session.get(url, timeout=getTimeout('detail'))
+
+                if resp.status_code == http.client.OK:
+                    # Append ID on good http response
+                    run['status'] = 'empty'
+
+                    data = resp.json()
+                    if 'info' in data and 'status' in data['info'] and data['info']['status'] == 'OK':
+                        # Found an APK update the Max. ID
+                        run['status'] = 'good'
+                        run['time']   = data['data']['modified']
+
+                        theArchs = data['data']['file']['hardware'].get('cpus', [])
+                        _arch = 'all'
+                        if len(theArchs) > 0:
+                            _arch = ','.join(theArchs)
+
+                        avi = ApkVersionInfo(name        =data['data']['package'],
+                                             arch        =_arch,
+                                             sdk         =data['data']['file']['hardware']['sdk'],
+                                             dpi         =self.doDpiStuff(data['data']['file']['hardware'].get('densities', [])),
+                                             ver         =data['data']['file']['vername'].split(' ')[0],  # Look at only the true version number
+                                             vercode     =data['data']['file']['vercode'],
+                                             download_src=data['data']['file']['path'],
+                                             malware=(data['data']['file']['malware'] if 'malware' in data['data']['file'] else ''),  # We only have this key if vercode is in options
+                                             crawler_name=self.__class__.__name__
+                                             )
+
+                        Debug.writeToFile(file_name, json.dumps(data, sort_keys=True,
+                                          indent=4, separators=(',', ': ')), resp.encoding)
+
+                        # Log AptoideID, Date, ApkID
+                        self.logIdAndDate(data['data'])
+
+                        # Check for beta support
+                        bCheckMore = False
+                        if self.report.needsBetaSupport(avi):
+                            import copy
+                            avibeta = copy.deepcopy(avi)
+                            avibeta.name += '.beta'
+                            needBeta = self.report.isThisApkNeeded(avibeta)
+
+                        # Do we already have it
+                        if self.report.isThisApkNeeded(avi):
+                            if (avi.malware['rank'] == "warn" and
+                                avi.malware['reason']['signature_validated']['status'] == "failed" and
+                                avi.malware['reason']['signature_validated']['signature_from'] == "market"):  # signature matches market, but it does not pass verification
+                                logging.error('{0} is a corrupt or incomplete APK, ignored.'.format(avi.download_src))
+                            else:
+                                # Are we sure we still need it after the additional info?
+                                if self.report.isThisApkNeeded(avi):
+                                    run['filename'] = self.downloadApk(avi)
+                            # END: if avi.malware
+
+                        if avi.name == 'org.opengapps.app':
+                            run['filename'] = '{0}-{1}_aptoideId-{2}.stub.apk'.format(avi.name, avi.vercode, aptoideId)
                     else:
-                        pass  # logging.error('HTTPStatus2: {0}, when fetching {1}, try {2}'.format(resp.status_code, file_name, x))
-                except:
-                    logging.exception('!!! Invalid JSON from: "{0}", retry in: {1}s'.format(url, wait))
-            # END: for x
+                        pass  # logging.error('data2[\'status\']: {0}, when fetching {1}'.format(data.get('status', 'null'), file_name))
+
+                    return run
+                elif resp.status_code in [http.client.UNAUTHORIZED,  # 401
+                                          http.client.FORBIDDEN,     # 403
+                                          http.client.NOT_FOUND,     # 404
+                                          http.client.GONE]:         # 410
+                    run['status'] = 'empty'
+                    return run
+                else:
+                    pass  # logging.error('HTTPStatus2: {0}, when fetching {1}'.format(resp.status_code, file_name))
+            except ValueError:  # Before RequestException: requests' JSONDecodeError is both
+                logging.exception('!!! Invalid JSON from: "{0}"'.format(url))
+            except requests.exceptions.RequestException as e:  # Also after the retries of httphelper
+                logging.error('!!! Request failed: "{0}": {1}'.format(url, e))
+            except:
+                logging.exception('!!! Unexpected data from: "{0}"'.format(url))
         # END: if data
         return run
     # END: def checkOneId
@@ -200,23 +206,33 @@ class AptoideCrawler(object):
                 logging.info('{0} already exists (in ../apkcrawler/)'.format(apkname))
                 return
 
+            if not claimDownload(avi):
+                return
+
             # Open the url
-            session = requests.Session()
-            r = session.get(url)
+            session = getSession(url, self.__class__.__name__)
+            r = session.get(url, stream=True, timeout=getTimeout('download'))
 
             if r.status_code != http.client.OK:
                 logging.exception('HTTP Status {0}. Failed to download: {1}'.format(r.status_code, apkname))
+                releaseDownload(avi)
                 return
 
-            with open(apkname, 'wb') as local_file:
-                local_file.write(r.content)
+            if not saveDownload(apkname, r.iter_content(readChunk)):
+                releaseDownload(avi)
+                return
 
             if ret:
+                self.report.recordDownload(avi)
+                streamDownload(apkname, avi, isBeta)
                 logging.debug(('beta:' if isBeta else 'reg :') + apkname)
                 return       (('beta:' if isBeta else ''     ) + apkname)
+            releaseDownload(avi)  # Leave it to a source with a trusted signature
         except socket.error as serr:
+            releaseDownload(avi)
             logging.exception('Socket error {0}. Failed to download: {1}'.format(serr, apkname))
         except OSError:
+            releaseDownload(avi)
             logging.exception('!!! Filename is not valid: "{0}"'.format(apkname))
     # END: def downloadApk
 
@@ -282,10 +298,9 @@ class AptoideCrawler(object):
             logging.info('Looking for {0} IDs from {1}'.format(len(storeIds), maxId))
 
             # Start checking AptoideIDs ...
-            p = multiprocessing.Pool(processes=threads, maxtasksperchild=5)  # Run only 5 tasks before re-placing the process; a lot of sequential requests from one IP still trigger 503, but the delay mechanism then kicks and in general fixes a retry
-            r = p.map_async(unwrap_self_checkOneId, list(zip([self] * len(storeIds), storeIds)), callback=unwrap_callback)
-            r.wait()
-            p.close()
+            p = multiprocessing.Pool(processes=threads, maxtasksperchild=5, initializer=unwrap_init, initargs=(self,))  # Run only 5 tasks before re-placing the process; a lot of sequential requests from one IP still trigger 503, but the shared rate limiter of the host then slows all workers down
+            (results, self.skipped) = mapWithinBudget(p, unwrap_self_checkOneId, storeIds, self.__class__.__name__)
+            unwrap_callback(results)
 
             # Proces this run's results
             localAllResults = unwrap_getresults()
@@ -400,6 +415,7 @@ def setStoreIds(configfile, runInfo):
 # END: def setStoreIds
 
 allresults = []
+worker     = None  # the crawler in a pool process, see unwrap_init()
 
 def unwrap_callback(results):
     for result in results:
@@ -411,8 +427,13 @@ def unwrap_getresults():
     return (allresults)
 
 
-def unwrap_self_checkOneId(arg, **kwarg):
-    return AptoideCrawler.checkOneId(*arg, **kwarg)
+def unwrap_init(crawler):
+    global worker
+    worker = crawler
+
+
+def unwrap_self_checkOneId(arg):
+    return worker.checkOneId(arg)
 
 if __name__ == "__main__":
     """
@@ -435,30 +456,34 @@ if __name__ == "__main__":
     logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    lines = ''
-    if len(sys.argv[1:]) == 1:
-        with open(sys.argv[1]) as report:
-            lines = report.readlines()
+    if len(sys.argv[1:]) == 1 and os.path.isdir(sys.argv[1]):
+        report = buildReport(sys.argv[1])
+    elif len(sys.argv[1:]) == 1:
+        with open(sys.argv[1]) as lines:
+            report = loadReport(lines)
     else:
-        lines = sys.stdin.readlines()
-
-    report = ReportHelper(lines)
+        report = loadReport(sys.stdin)
 
     if len(list(report.getAllApkIds())) == 0:
         print('ERROR: expecting:')
         print(' - 1 parameter (report file from output of report_sources.sh)')
         print(' or ')
+        print(' - 1 parameter (Open GApps sources directory)')
+        print(' or ')
         print(' - stdin from report_sources.sh')
         exit(1)
 
     crawler = AptoideCrawler(report)
-    crawler.crawl()
+    openStream()  # Before the pool forks, so all its workers share the stream
+    with claimRun():
+        crawler.crawl()
+        logMetrics()
 
     outputString = ' '.join(crawler.dlFiles)
     if crawler.dlFilesBeta:
         outputString += ' beta ' + ' '.join(crawler.dlFilesBeta)
 
-    if outputString:
+    if outputString and not isStreamingStdout():
         print(outputString)
         sys.stdout.flush()
 
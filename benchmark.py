@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks for the report handling code (ReportHelper/ApkVersionInfo)
+# These run offline on a synthetic report_sources.sh table
+#
+# Usage: ./benchmark.py [benchmark ...]
+#
+
+import gc
+import io
+import logging
+import os
+import pickle
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from apkhelper import ApkVersionInfo, reName
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, convertReport, loadReport, rankVersions
+
+
+def syntheticReport(rows, seed=0):
+    """
+    syntheticReport(rows, seed): Generate report_sources.sh style lines with about
+                                 40 rows per package; like a real report, each package
+                                 has a few versions spread over many arch/sdk/dpi variants
+    """
+    rnd      = random.Random(seed)
+    packages = ['com.google.android.gms',
+                'com.google.android.googlequicksearchbox',
+                'com.google.android.apps.docs',
+                'com.google.android.projection.gearhead',
+                'com.google.android.webview',
+                'com.google.android.webview.beta',
+                'com.android.vending',
+                'com.android.vending.leanback']
+    packages.extend('com.example.app{0}'.format(x) for x in range(max(1, rows // 40)))
+    versions = {}
+    for name in packages:
+        versions[name] = ['{0}.{1}.{2}{3}'.format(rnd.randint(1, 20), rnd.randint(0, 30), rnd.randint(0, 99),
+                                                  rnd.choice(['', ' (040400-123)', '-beta', '.release']))
+                          for x in range(rnd.randint(1, 6))]
+
+    lines = []
+    for x in range(rows):
+        name = rnd.choice(packages)
+        arch = rnd.choice(['all', 'arm', 'arm64', 'x86', 'x86_64'])
+        sdk  = rnd.choice(['19', '21', '23', '24', '26', '28'])
+        dpi  = rnd.choice(['nodpi', '160', '240', '320', '480', '240-320-480'])
+        ver  = rnd.choice(versions[name])
+        code = str(rnd.randint(100, 99999999))
+        lines.append('  {0:<45}|{1:<7}|{2:<4}|{3:<12}|{4:<30}|{5:<10}|{6:<6}|{7}\n'.format(name, arch, sdk, dpi, ver, code, '12.3', 'ff00ff00'))
+    return lines
+# END: def syntheticReport
+
+
+def syntheticManifest(package, versionName, versionCode):
+    """
+    syntheticManifest(package, versionName, versionCode): Binary AndroidManifest.xml with only
+                                                          a <manifest> element
+    """
+    strings = ['versionCode', 'versionName', 'package', 'manifest', 'http://schemas.android.com/apk/res/android', package, versionName]
+    pool    = b''
+    starts  = []
+    for string in strings:
+        starts.append(len(pool))
+        pool += struct.pack('<H', len(string)) + string.encode('utf-16-le') + b'\0\0'
+    pool += b'\0' * (-len(pool) % 4)
+    header = 28 + 4 * len(strings)
+    chunks = struct.pack('<HHIIIIII', 0x0001, 28, header + len(pool), len(strings), 0, 0, header, 0) + struct.pack('<{0}I'.format(len(strings)), *starts) + pool
+    chunks += struct.pack('<HHIII', 0x0180, 8, 16, 0x0101021b, 0x0101021c)
+
+    attrs = [(4, 0, 0xFFFFFFFF, 0x10, versionCode),  # android:versionCode
+             (4, 1, 6, 0x03, 6),                     # android:versionName
+             (0xFFFFFFFF, 2, 5, 0x03, 5)]            # package
+    chunks += struct.pack('<HHIIIIIHHHHHH', 0x0102, 16, 36 + 20 * len(attrs), 1, 0xFFFFFFFF, 0xFFFFFFFF, 3, 20, 20, len(attrs), 0, 0, 0)
+    for (ns, name, raw, dataType, data) in attrs:
+        chunks += struct.pack('<IIIHBBI', ns, name, raw, 8, 0, dataType, data)
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(chunks)) + chunks
+# END: def syntheticManifest
+
+
+def syntheticSources(sourcesdir, lines):
+    """
+    syntheticSources(sourcesdir, lines): Create an Open GApps sources tree with a minimal APK for
+                                         each line of a synthetic report
+                                         Like in the real tree, the variants (e.g. .leanback or
+                                         .beta) have the package of the base app in their manifest
+    """
+    for line in lines:
+        (name, arch, sdk, dpi, ver, code) = [c.strip() for c in line.split('|')[:6]]
+        apkdir = os.path.join(sourcesdir, arch, 'app', name, sdk, dpi)
+        os.makedirs(apkdir, exist_ok=True)
+        m = reName.match(name)
+        with zipfile.ZipFile(os.path.join(apkdir, code + '.apk'), 'w') as apk:
+            apk.writestr('AndroidManifest.xml', syntheticManifest(m.group('name') if m else name, ver, int(code)))
+            apk.writestr('classes.dex', b'\0' * 1024)
+# END: def syntheticSources
+
+
+class RowsOnlyReport(ReportHelper):
+    """RowsOnlyReport: only parses the report rows, without building the per APK indexes"""
+    def addApks(self, avis):
+        pass
+# END: class RowsOnlyReport
+
+
+def benchJson(sizes=(1000, 10000, 100000)):
+    """
+    benchJson(sizes): Loading the report_sources.sh table and the same report as NDJSON, for the
+                      rows alone (including ApkVersionInfo) and for the complete ReportHelper,
+                      and whether both give the same ReportHelper
+                      Most of a complete load is building the per APK indexes, which takes the
+                      same time for both formats
+    """
+    for rows in sizes:
+        lines  = syntheticReport(rows)
+        output = io.StringIO()
+        convertReport(lines, output)
+        ndjson = output.getvalue().splitlines(True)
+
+        times = []
+        for (cls, report) in [(RowsOnlyReport, lines), (RowsOnlyReport, ndjson), (ReportHelper, lines), (ReportHelper, ndjson)]:
+            best = None
+            for x in range(3):
+                gc.collect()
+                start = time.perf_counter()
+                cls(report)
+                best = min(best or 1e9, time.perf_counter() - start)
+            times.append(best)
+
+        same = ReportHelper(lines).variantsEachApk == ReportHelper(ndjson).variantsEachApk
+        print('json: {0:>6} rows, rows only: table {1:.4f}s, ndjson {2:.4f}s; complete: table {3:.4f}s, ndjson {4:.4f}s; same: {5}'.format(
+              rows, times[0], times[1], times[2], times[3], same))
+# END: def benchJson
+
+
+def benchMemory(rows=10000):
+    """
+    benchMemory(rows): Bytes allocated per ApkVersionInfo on its own and per row of a
+                       fully parsed ReportHelper
+    """
+    lines = syntheticReport(rows)
+    cols  = [[c.strip() for c in line.split('|')[:6]] for line in lines]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    avis   = [ApkVersionInfo(name=c[0], arch=c[1], sdk=c[2], dpi=c[3], ver=c[4], vercode=c[5]) for c in cols]
+    after  = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    perAvi = sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / len(avis)
+    del avis
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    report = ReportHelper(lines)
+    after  = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    perRow = sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / rows
+    del report
+
+    print('memory: {0} rows, {1:.0f} bytes per ApkVersionInfo, {2:.0f} bytes per parsed report row'.format(rows, perAvi, perRow))
+# END: def benchMemory
+
+
+def benchRanking(sizes=(1000, 10000, 100000)):
+    """
+    benchRanking(sizes): Per package max and older-than-max masks, pairwise ApkVersionInfo
+                         comparisons versus the batch rankVersions()
+    """
+    for rows in sizes:
+        report = ReportHelper(syntheticReport(rows))
+        avis   = [avi for apks in report.dAllApks.values() for avi in apks]
+
+        for avi in avis:  # start both from uncached version keys
+            avi._verKey = avi._verKeySrc = None
+        start = time.perf_counter()
+        for apks in report.dAllApks.values():
+            maxApk = max(apks)
+            older  = [apk < maxApk for apk in apks]
+        pairwise = time.perf_counter() - start
+
+        for avi in avis:
+            avi._verKey = avi._verKeySrc = None
+        start = time.perf_counter()
+        rankVersions(report.dAllApks)
+        batch = time.perf_counter() - start
+
+        print('ranking: {0:>6} rows, pairwise {1:.4f}s, batch {2:.4f}s ({3:.1f}x)'.format(rows, pairwise, batch, pairwise / batch))
+# END: def benchRanking
+
+
+def benchStartup(sizes=(1000, 10000, 100000)):
+    """
+    benchStartup(sizes): Crawler startup without the report cache, with an empty cache (cold,
+                         includes writing it) and with a filled cache (warm)
+    """
+    for rows in sizes:
+        lines = syntheticReport(rows)
+        (fd, cachefile) = tempfile.mkstemp(suffix='.cache')
+        os.close(fd)
+        os.remove(cachefile)
+        try:
+            start = time.perf_counter()
+            ReportHelper(lines)
+            nocache = time.perf_counter() - start
+
+            start = time.perf_counter()
+            loadReport(lines, cachefile)
+            cold = time.perf_counter() - start
+
+            start = time.perf_counter()
+            loadReport(lines, cachefile)
+            warm = time.perf_counter() - start
+
+            print('startup: {0:>6} rows, no cache {1:.4f}s, cold {2:.4f}s, warm {3:.4f}s ({4:.1f}x), cache {5} KiB'.format(
+                  rows, nocache, cold, warm, nocache / warm, os.path.getsize(cachefile) // 1024))
+        finally:
+            if os.path.exists(cachefile):
+                os.remove(cachefile)
+# END: def benchStartup
+
+
+class IpcCrawler(object):
+    """IpcCrawler: like the real crawlers, holds only the report and the results"""
+    def __init__(self, report):
+        self.report      = report
+        self.dlFiles     = []
+        self.dlFilesBeta = []
+# END: class IpcCrawler
+
+
+def benchApkIds(sizes=(1000, 10000, 100000), calls=1000):
+    """
+    benchApkIds(sizes, calls): Cost per getAllApkIds() call when each view is rebuilt versus
+                               when the memoized view is returned
+    """
+    for rows in sizes:
+        report = ReportHelper(syntheticReport(rows))
+        views  = [{}, {'playstoreCaps': True}]
+
+        start = time.perf_counter()
+        for x in range(calls):
+            for view in views:
+                report.apkIdsCache = {}
+                report.getAllApkIds(**view)
+        rebuilt = (time.perf_counter() - start) / (calls * len(views))
+
+        start = time.perf_counter()
+        for x in range(calls):
+            for view in views:
+                report.getAllApkIds(**view)
+        memoized = (time.perf_counter() - start) / (calls * len(views))
+
+        print('apkids: {0:>6} rows, {1} ids, rebuilt {2:.2f}us/call, memoized {3:.2f}us/call ({4:.0f}x)'.format(
+              rows, len(report.getAllApkIds()), rebuilt * 1e6, memoized * 1e6, rebuilt / memoized))
+# END: def benchApkIds
+
+
+def benchIpc(sizes=(1000, 10000, 100000), threads=5):
+    """
+    benchIpc(sizes, threads): Pickled task bytes that Pool.map_async() sends to the workers when
+                              each task carries the crawler (and so the report) with the apkid,
+                              versus only the apkid with the crawler inherited via the initializer
+    """
+    for rows in sizes:
+        crawler = IpcCrawler(ReportHelper(syntheticReport(rows)))
+        apkids  = list(crawler.report.getAllApkIds())
+
+        # Same chunking as Pool.map_async(); each chunk is pickled on its own
+        (chunksize, extra) = divmod(len(apkids), threads * 4)
+        chunksize += 1 if extra else 0
+        chunks = [range(x, min(x + chunksize, len(apkids))) for x in range(0, len(apkids), chunksize)]
+
+        withSelf = sum(len(pickle.dumps([(crawler, apkids[x]) for x in chunk])) for chunk in chunks)
+        onlyId   = sum(len(pickle.dumps([apkids[x] for x in chunk])) for chunk in chunks)
+
+        print('ipc: {0:>6} rows, {1} tasks, crawler+apkid {2:.0f} bytes/task, apkid {3:.0f} bytes/task ({4:.0f}x)'.format(
+              rows, len(apkids), withSelf / len(apkids), onlyId / len(apkids), withSelf / onlyId))
+# END: def benchIpc
+
+
+def benchBuilder(sizes=(1000, 10000)):
+    """
+    benchBuilder(sizes): Building the report from a sources tree, reading all APKs (cold) and
+                         with all manifests cached (warm); checks it equals the parsed report
+    """
+    for rows in sizes:
+        lines = syntheticReport(rows)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sourcesdir = os.path.join(tmpdir, 'sources')
+            cachefile  = os.path.join(tmpdir, 'reportbuilder.cache')
+            syntheticSources(sourcesdir, lines)
+
+            start = time.perf_counter()
+            buildReport(sourcesdir, cachefile)
+            cold = time.perf_counter() - start
+
+            start = time.perf_counter()
+            report = buildReport(sourcesdir, cachefile)
+            warm = time.perf_counter() - start
+
+        parsed = ReportHelper(lines)
+        same   = all(getattr(report, index) == getattr(parsed, index) for index in
+                     ['maxVerEachApk', 'minSdkEachApk', 'vercodesEachApk', 'realversEachApk', 'variantsEachApk', 'betaEachApk'])
+        print('builder: {0:>6} APKs, cold {1:.4f}s, warm {2:.4f}s ({3:.1f}x), same as parsed report: {4}'.format(
+              rows, cold, warm, cold / warm, same))
+# END: def benchBuilder
+
+
+allBenchmarks = {
+    'apkids' : benchApkIds,
+    'builder': benchBuilder,
+    'ipc'    : benchIpc,
+    'json'   : benchJson,
+    'memory' : benchMemory,
+    'ranking': benchRanking,
+    'startup': benchStartup}
+
+if __name__ == "__main__":
+    """
+    main(): run the named benchmarks, or all of them
+    """
+    logging.basicConfig(level=logging.WARNING)
+
+    names = sys.argv[1:] or sorted(allBenchmarks.keys())
+    for name in names:
+        if name not in allBenchmarks:
+            print('ERROR: unknown benchmark "{0}", expecting one of: {1}'.format(name, ' '.join(sorted(allBenchmarks.keys()))))
+            exit(1)
+        start = time.perf_counter()
+        allBenchmarks[name]()
+        logging.debug('{0} took {1:.2f}s'.format(name, time.perf_counter() - start))
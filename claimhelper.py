@@ -0,0 +1,264 @@
+import contextlib
+import glob
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+# The claims directory of the current run, shared with all (forked) crawler processes
+claimsEnv = 'APKCRAWLER_CLAIMS'
+
+# The marker file whose existence cancels the downloads of this process and its children,
+# see watchCancel(); unset means the crawl cannot be cancelled
+cancelEnv = 'APKCRAWLER_CANCEL'
+
+reUnsafe = re.compile('[^A-Za-z0-9._-]')
+
+ownClaims = set()  # Claim files created by this process
+satisfied = set()  # Needs fulfilled by this process, see markSatisfied()
+
+
+@contextlib.contextmanager
+def claimRun():
+    """
+    claimRun(): Context for a crawler run; all crawlers started inside it share one claims
+                directory, so each APK is downloaded by only one of them
+                A nested claimRun() uses the claims directory of the outer one
+    """
+    if os.environ.get(claimsEnv):
+        yield
+        return
+
+    os.environ[claimsEnv] = tempfile.mkdtemp(prefix='apkcrawler-claims.')
+    try:
+        yield
+    finally:
+        shutil.rmtree(os.environ.pop(claimsEnv), ignore_errors=True)
+# END: def claimRun
+
+
+def getClaimFile(avi):
+    """
+    getClaimFile(avi): The claim file for the package and vercode (or realver, if the vercode
+                       is unknown) of avi, or None if there is nothing to claim on
+    """
+    claimsdir = os.environ.get(claimsEnv)
+    if not claimsdir:
+        return None
+
+    if avi.vercode != 0:
+        key = '{0}-{1}'.format(avi.lowername, avi.vercode)
+    elif avi.realver != '':
+        key = '{0}-ver-{1}'.format(avi.lowername, avi.realver)
+    else:
+        return None
+    return os.path.join(claimsdir, reUnsafe.sub('_', key))
+# END: def getClaimFile
+
+
+def claimDownload(avi):
+    """
+    claimDownload(avi): Return True if the download of avi is ours, False if another crawler
+                        (or worker) of this run already claimed it
+                        Outside of a claimRun() every download is ours
+    """
+    if isCancelled():
+        logging.info('Not downloading {0}, the crawl is cancelled'.format(avi.getFilename()))
+        return False
+
+    claimfile = getClaimFile(avi)
+    if not claimfile:
+        return True
+
+    try:
+        fd = os.open(claimfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            with open(claimfile) as claim_file:
+                owner = claim_file.read()
+        except OSError:
+            owner = 'unknown'
+        logging.info('{0} is already claimed by {1}'.format(avi.getFilename(), owner or 'unknown'))
+        return False
+
+    with os.fdopen(fd, 'w') as claim_file:
+        claim_file.write('{0}({1})'.format(avi.crawler_name, os.getpid()))
+    ownClaims.add(claimfile)
+    return True
+# END: def claimDownload
+
+
+def releaseDownload(avi):
+    """
+    releaseDownload(avi): Give up our claim on avi after a failed download, so another
+                          crawler can still download it
+    """
+    claimfile = getClaimFile(avi)
+    if claimfile in ownClaims:
+        ownClaims.discard(claimfile)
+        try:
+            os.remove(claimfile)
+        except OSError:
+            pass
+# END: def releaseDownload
+
+
+def getPartName(apkname, pid=None):
+    """
+    getPartName(apkname, pid): The file that the download of apkname by process pid (default:
+                               this process) is written to until it is complete
+    """
+    return '{0}.{1}.part'.format(apkname, pid or os.getpid())
+# END: def getPartName
+
+
+def saveDownload(apkname, chunks):
+    """
+    saveDownload(apkname, chunks): Write the chunks (bytes) of a download to apkname; return
+                                   False (writing nothing) if the crawl got cancelled first
+                                   The chunks go to a .part file that only replaces apkname once
+                                   complete, so an interrupted download never leaves a truncated
+                                   APK behind under its final name
+    """
+    partname  = getPartName(apkname)
+    cancelled = False
+    try:
+        with open(partname, 'wb') as local_file:
+            for chunk in chunks:
+                cancelled = isCancelled()
+                if cancelled:
+                    break
+                local_file.write(chunk)
+        if not cancelled:
+            os.replace(partname, apkname)
+            return True
+    except BaseException:
+        removePart(partname)
+        raise
+
+    logging.info('Not saving {0}, the crawl is cancelled'.format(apkname))
+    removePart(partname)
+    return False
+# END: def saveDownload
+
+
+def removePart(partname):
+    """
+    removePart(partname): Remove the .part file of an unfinished download, if any
+    """
+    try:
+        os.remove(partname)
+    except OSError:
+        pass
+# END: def removePart
+
+
+def getRunFile(name):
+    """
+    getRunFile(name): The file name in the claims directory for state that all crawlers of this
+                      run share, or None outside of a claimRun()
+    """
+    claimsdir = os.environ.get(claimsEnv)
+    if not claimsdir:
+        return None
+    return os.path.join(claimsdir, reUnsafe.sub('_', name))
+# END: def getRunFile
+
+
+def getCancelMarker(name):
+    """
+    getCancelMarker(name): The marker file that cancels the crawl named name, or None outside
+                           of a claimRun()
+    """
+    return getRunFile('cancel.' + name)
+# END: def getCancelMarker
+
+
+def watchCancel(name):
+    """
+    watchCancel(name): Let cancelCrawl(name) cancel the downloads of this process (and its
+                       children): no new claims, and downloads in progress stop between chunks
+    """
+    os.environ[cancelEnv] = getCancelMarker(name) or ''
+# END: def watchCancel
+
+
+def cancelCrawl(name):
+    """
+    cancelCrawl(name): Cancel the crawl of the process(es) that called watchCancel(name)
+    """
+    marker = getCancelMarker(name)
+    if marker:
+        open(marker, 'w').close()
+# END: def cancelCrawl
+
+
+def isCancelled():
+    """
+    isCancelled(): Return True if the crawl of this process has been cancelled, see watchCancel()
+    """
+    marker = os.environ.get(cancelEnv)
+    return bool(marker) and os.path.exists(marker)
+# END: def isCancelled
+
+
+def abandonProcess(pid):
+    """
+    abandonProcess(pid): Clean up after the crawler process pid was killed: release its claims,
+                         so other crawlers can still download those APKs, and remove its
+                         unfinished (.part) downloads
+    """
+    claimsdir = os.environ.get(claimsEnv)
+    if claimsdir:
+        owner = '({0})'.format(pid).encode()
+        for claimfile in glob.glob(os.path.join(claimsdir, '*')):
+            try:
+                with open(claimfile, 'rb') as claim_file:  # The run also keeps binary state here
+                    if claim_file.read().endswith(owner):
+                        os.remove(claimfile)
+                        logging.info('Released claim {0} of killed process {1}'.format(os.path.basename(claimfile), pid))
+            except OSError:
+                pass
+
+    for partname in glob.glob(getPartName('*', pid)):
+        removePart(partname)
+# END: def abandonProcess
+
+
+def markSatisfied(key):
+    """
+    markSatisfied(key): Record for the whole run (all crawlers inside the claimRun()) that the
+                        need identified by key is fulfilled
+    """
+    key = reUnsafe.sub('_', key)
+    satisfied.add(key)
+
+    claimsdir = os.environ.get(claimsEnv)
+    if claimsdir:
+        try:
+            open(os.path.join(claimsdir, 'satisfied.' + key), 'w').close()
+        except OSError:
+            logging.exception('!!! Unable to record satisfied need: "{0}"'.format(key))
+# END: def markSatisfied
+
+
+def getSatisfied():
+    """
+    getSatisfied(): Return the keys (as passed to markSatisfied) of all needs fulfilled in this run
+    """
+    keys = set(satisfied)
+
+    claimsdir = os.environ.get(claimsEnv)
+    if claimsdir:
+        keys.update(name[10:] for name in os.listdir(claimsdir) if name.startswith('satisfied.'))
+    return keys
+# END: def getSatisfied
+
+
+def getSatisfiedKey(name, arch):
+    """
+    getSatisfiedKey(name, arch): The key of the need for a newer arch variant of package name
+    """
+    return reUnsafe.sub('_', '{0}-{1}'.format(name, arch))
+# END: def getSatisfiedKey
@@ -19,6 +19,8 @@ from google.protobuf import text_format
 from google.protobuf.message import Message, DecodeError
 
 import googleplayapi.googleplay_pb2
+from httphelper import createSession
+from timeouthelper import getTimeout
 
 
 class LoginError(Exception):
@@ -137,6 +139,7 @@ class GooglePlayAPI(object):
         self.preFetch = {}
         self.androidId = androidId
         self.lang = lang
+        self.session = createSession(self.__class__.__name__)  # Own cookies, not shared with other accounts
         # Finsky is the nickname of the old Android Market app
         # The number is a string of the Play Store app Version Name
         # The api is the play store protocol api (probably)
@@ -221,7 +224,7 @@ class GooglePlayAPI(object):
                 headers = {
                     "Accept-Encoding": "gzip, deflate",
                 }
-                response = requests.post(self.URL_LOGIN, data=params, headers=headers, proxies=proxy, verify=False)
+                response = self.session.post(self.URL_LOGIN, data=params, headers=headers, proxies=proxy, verify=False, timeout=getTimeout('detail'))
 
                 if response.status_code != http.client.OK:
                     logging.error('{0} Play Store login failed, statuscode {1}: {2}'.format(self.androidId, response.status_code, response.content))
@@ -272,9 +275,9 @@ class GooglePlayAPI(object):
             url = "https://android.clients.google.com/fdfe/%s" % path
             if datapost is not None:
                 headers["Content-Type"] = post_content_type
-                response = requests.post(url, data=datapost, headers=headers, proxies=self.proxy_dict, verify=False)
+                response = self.session.post(url, data=datapost, headers=headers, proxies=self.proxy_dict, verify=False, timeout=getTimeout('detail'))
             else:
-                response = requests.get(url, headers=headers, proxies=self.proxy_dict, verify=False)
+                response = self.session.get(url, headers=headers, proxies=self.proxy_dict, verify=False, timeout=getTimeout('detail'))
             if response.status_code != http.client.OK:
                 return (response.status_code, None)
             data = response.content
@@ -384,13 +387,16 @@ class GooglePlayAPI(object):
             return RequestResult(status_code, message.payload.listResponse)
         return RequestResult(status_code, None)
 
-    def download(self, packageName, versionCode, offerType=1, agentvername=None, agentvercode=None, devicename="sailfish"):
+    def download(self, packageName, versionCode, offerType=1, agentvername=None, agentvercode=None, devicename="sailfish", chunkSize=None):
         """Download an app and return its raw data (APK file).
 
         packageName is the app unique ID (usually starting with 'com.').
 
         versionCode can be grabbed by using the details() method on the given
-        app."""
+        app.
+
+        With chunkSize the raw data is streamed: it is an iterator over chunks
+        of at most chunkSize bytes, read as they are consumed."""
         (status_code, message) = self.executeRequestApi2(path="delivery?ot=%d&doc=%s&vc=%d&shh=%s" % (offerType, packageName, versionCode, "1"), agentvername=agentvername, agentvercode=agentvercode, devicename=devicename)
 
         if status_code == http.client.OK:
@@ -417,9 +423,11 @@ class GooglePlayAPI(object):
                 "Accept-Encoding": "",  # TODO try adding gzip and deflate here too
             }
 
-            response = requests.get(url, headers=headers, cookies=cookies, proxies=self.proxy_dict, verify=False)
+            response = self.session.get(url, headers=headers, cookies=cookies, proxies=self.proxy_dict, verify=False, stream=chunkSize is not None, timeout=getTimeout('download'))
             if response.status_code != http.client.OK:
                 return (response.status_code, None)  # returns the reponse-status_code of the 2nd request
+            elif chunkSize is not None:
+                return RequestResult(response.status_code, response.iter_content(chunkSize))
             else:
                 return RequestResult(response.status_code, response.content)  # take care that this response is different from the other return functions, it concerns the APK content itself (of the 2nd request)
         return RequestResult(status_code, None)  # returns the reponse-status_code of the initial request
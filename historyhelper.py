@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+
+# Rolling latency and success history of each source, kept between runs
+historyFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'apkcrawler.history')
+historyRuns = 10  # Runs kept per source
+
+
+def loadHistory(file_name=historyFile):
+    """
+    loadHistory(file_name): Return {source: [{'seconds', 'packages', 'ok'}, ...]}, oldest run first
+    """
+    if os.path.isfile(file_name):
+        try:
+            with open(file_name, 'r') as history_file:
+                return json.load(history_file)
+        except (OSError, ValueError):
+            logging.exception('!!! Ignoring unreadable history: "{0}"'.format(file_name))
+    return {}
+# END: def loadHistory
+
+
+def saveHistory(history, file_name=historyFile):
+    """
+    saveHistory(history, file_name): Atomically replace the history file
+    """
+    try:
+        tmpfile = '{0}.{1}'.format(file_name, os.getpid())
+        with open(tmpfile, 'w') as history_file:
+            json.dump(history, history_file, sort_keys=True, indent=4, separators=(',', ': '))
+        os.replace(tmpfile, file_name)
+    except OSError:
+        logging.exception('!!! Unable to write history: "{0}"'.format(file_name))
+# END: def saveHistory
+
+
+def recordRun(history, source, seconds, packages, ok):
+    """
+    recordRun(history, source, seconds, packages, ok): Add one run of a source that checked
+                                                       packages in seconds, and whether it
+                                                       finished without errors
+    """
+    runs = history.setdefault(source, [])
+    runs.append({'seconds': round(seconds, 3), 'packages': packages, 'ok': ok})
+    del runs[:-historyRuns]
+# END: def recordRun
+
+
+def getScore(history, source):
+    """
+    getScore(history, source): Average seconds per package of the source, divided by its success
+                               rate; lower is better and a source without history scores 0 so
+                               it gets measured first
+    """
+    runs = history.get(source)
+    if not runs:
+        return 0.0
+
+    perPackage  = sum(run['seconds'] / max(run['packages'], 1) for run in runs) / len(runs)
+    successRate = sum(1 for run in runs if run['ok']) / len(runs)
+    return perPackage / max(successRate, 0.1)
+# END: def getScore
+
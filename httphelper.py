@@ -0,0 +1,198 @@
+import http.client
+import logging
+import multiprocessing.util
+import os
+import time
+import urllib.parse
+import weakref
+
+import requests
+import requests.adapters
+
+from ratehelper import relaxHost, throttleHost, waitForHost
+from retryhelper import callWithRetry, getRetryAfter, retryDeadline
+from timeouthelper import RequestTimeout, clampTimeout, getRemaining, getTimeout
+
+# Keep-alive pools of each session: the number of hosts (including redirect targets, e.g. CDNs)
+# kept pooled, and the number of connections kept open to each of them
+poolHosts = int(os.environ.get('APKCRAWLER_POOL_HOSTS', 10))
+poolSize  = int(os.environ.get('APKCRAWLER_POOL_SIZE', 4))
+
+# Responses that mean the host wants us to slow down
+throttleStatus = (http.client.TOO_MANY_REQUESTS, http.client.SERVICE_UNAVAILABLE)
+
+# Responses and errors that are worth a retry, see retryhelper
+retryStatus = (http.client.TOO_MANY_REQUESTS,
+               http.client.INTERNAL_SERVER_ERROR,
+               http.client.BAD_GATEWAY,
+               http.client.SERVICE_UNAVAILABLE,
+               http.client.GATEWAY_TIMEOUT)
+retryErrors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# Only requests with these methods are retried; a retried POST (e.g. a login or a purchase)
+# could take effect twice
+retryMethods = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+readChunk = 16 * 1024  # Bytes read between checks of the total timeout of a request
+
+sessions    = {}                 # Shared sessions of this process by (source, host), see getSession()
+allSessions = weakref.WeakSet()  # All sessions of this process, including those of createSession()
+sessionsPid = None               # Process that owns sessions; a forked worker starts with its own
+
+
+class LimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    LimitedAdapter: HTTPAdapter that paces the requests to each host with its rate limiter
+                    (see ratehelper) and retries transient failures (see retryhelper) on
+                    behalf of source, including each hop of a redirect; only requests
+                    with one of the retryMethods are retried
+                    The timeout of a request is a RequestTimeout (see timeouthelper), by
+                    default that of a 'detail' request, cut short by the crawl budget
+    """
+    def __init__(self, source, **kwargs):
+        super(LimitedAdapter, self).__init__(**kwargs)
+        self.source = source
+
+    def send(self, request, timeout=None, **kwargs):
+        if not isinstance(timeout, RequestTimeout):
+            timeout = getTimeout('detail')
+        if request.method not in retryMethods:
+            return self.sendOnce(request, timeout, **kwargs)
+
+        remaining = getRemaining()
+        deadline  = retryDeadline if remaining is None else min(retryDeadline, remaining)
+        return callWithRetry(self.source, lambda: self.sendOnce(request, timeout, **kwargs), getRetryWait, retryErrors, deadline)
+    # END: def send
+
+    def sendOnce(self, request, timeout, **kwargs):
+        timeout = clampTimeout(timeout)
+        if timeout.total <= 0.0:
+            raise requests.exceptions.Timeout('Crawl budget spent, not requesting {0}'.format(request.url))
+
+        host = urllib.parse.urlsplit(request.url).hostname
+        waitForHost(host)
+        stop = time.monotonic() + timeout.total
+        try:
+            response = super(LimitedAdapter, self).send(request, timeout=(timeout.connect, timeout.read), **kwargs)
+            limitStream(response, stop)
+            if not kwargs.get('stream'):
+                response._content = b''.join(response.iter_content(readChunk))
+        except requests.exceptions.ConnectionError:
+            throttleHost(host, 'connection error')
+            raise
+
+        if response.status_code in throttleStatus:
+            throttleHost(host, 'HTTP {0}'.format(response.status_code))
+        elif response.status_code < http.client.INTERNAL_SERVER_ERROR:
+            relaxHost(host)
+        return response
+    # END: def sendOnce
+# END: class LimitedAdapter
+
+
+def limitStream(response, stop):
+    """
+    limitStream(response, stop): Make reading the body of response (its iter_content()) raise a
+                                 ReadTimeout once it takes until after stop (time.monotonic()),
+                                 also when the caller streams it (stream=True)
+                                 The time is checked after each chunk
+    """
+    iterContent = response.iter_content
+
+    def iterWithin(*args, **kwargs):
+        for chunk in iterContent(*args, **kwargs):
+            if time.monotonic() > stop:
+                response.close()
+                raise requests.exceptions.ReadTimeout('Reading {0} took longer than its total timeout'.format(response.url))
+            yield chunk
+    response.iter_content = iterWithin
+# END: def limitStream
+
+
+def getRetryWait(response):
+    """
+    getRetryWait(response): None if response is final, else the seconds to wait at least
+                            before a retry
+    """
+    if response.status_code not in retryStatus:
+        return None
+    return getRetryAfter(response)
+# END: def getRetryWait
+
+
+def getSession(url, source=None):
+    """
+    getSession(url, source): The requests.Session of this process for the host of url, so
+                             subsequent requests to it reuse their (keep-alive) connections
+                             instead of doing a new TCP and TLS handshake each; its requests
+                             are rate limited per host and retried on behalf of source
+                             (default: the host)
+                             All requests of source to the host in this process share it and
+                             its cookies; requests on behalf of an account use createSession()
+    """
+    checkProcess()
+    host    = urllib.parse.urlsplit(url).netloc.lower()
+    source  = source or host
+    session = sessions.get((source, host))
+    if session is None:
+        session = createSession(source)
+        sessions[(source, host)] = session
+    return session
+# END: def getSession
+
+
+def createSession(source):
+    """
+    createSession(source): A new requests.Session like those of getSession(), with its own cookies
+                           and keep-alive connections, e.g. for the requests of one account
+    """
+    checkProcess()
+    adapter = LimitedAdapter(source, pool_connections=poolHosts, pool_maxsize=poolSize)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    allSessions.add(session)
+    return session
+# END: def createSession
+
+
+def checkProcess():
+    """
+    checkProcess(): Start without sessions in a new (e.g. forked) process
+    """
+    global sessionsPid
+    if sessionsPid != os.getpid():
+        # Never share the sockets of the parent process with a forked worker
+        sessions.clear()
+        allSessions.clear()
+        sessionsPid = os.getpid()
+        multiprocessing.util.Finalize(None, logStats, exitpriority=10)
+# END: def checkProcess
+
+
+def getStats():
+    """
+    getStats(): Return {host: (requests, connections)} of the pooled connections of this process
+    """
+    stats = {}
+    for session in list(allSessions):
+        pools = session.get_adapter('https://').poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            (requestsDone, connections) = stats.get(pool.host, (0, 0))
+            stats[pool.host] = (requestsDone + pool.num_requests, connections + pool.num_connections)
+    return stats
+# END: def getStats
+
+
+def logStats():
+    """
+    logStats(): Log the connection reuse of each host, called when the process exits
+    """
+    for (host, (requestsDone, connections)) in sorted(getStats().items()):
+        if requestsDone:
+            logging.info('HTTP {0}: {1} requests over {2} connections ({3:.0f}% reused)'.format(
+                         host, requestsDone, connections, 100.0 * (requestsDone - connections) / requestsDone))
+# END: def logStats
@@ -15,7 +15,13 @@ from googleplayapi.googleplay import GooglePlayAPI
 
 from debug import Debug
 from apkhelper import ApkVersionInfo
-from reporthelper import ReportHelper
+from claimhelper import claimDownload, claimRun, releaseDownload, saveDownload
+from httphelper import readChunk
+from streamhelper import isStreamingStdout, openStream, streamDownload
+from retryhelper import logMetrics
+from timeouthelper import mapWithinBudget, sleepWithin
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, loadReport
 
 ###########################
 # DO NOT TRY THIS AT HOME #
@@ -39,9 +45,7 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)  # suppress c
 ###################
 # Globals         #
 ###################
-manager = multiprocessing.Manager()
-Global  = manager.Namespace()
-Global.offerType = 1  # safe to assume for all our downloads
+offerType = 1  # safe to assume for all our downloads
 
 # logging
 logFile   = '{0}.log'.format(os.path.basename(__file__))
@@ -85,6 +89,7 @@ class PlayStoreCrawler(object):
         self.report      = report
         self.dlFiles     = dlFiles
         self.dlFilesBeta = dlFilesBeta
+        self.skipped     = []  # What was not checked within the crawl budget, see mapWithinBudget()
 
     def checkPlayStore(self, credentials, lang="en_US"):
         """
@@ -95,7 +100,9 @@ class PlayStoreCrawler(object):
         playstore = GooglePlayAPI(credentials.androidId, lang)
         if playstore.login(authSubToken=credentials.authSubToken):
             logging.info('{0} searches Play in {1} seconds'.format(credentials.androidId, credentials.delay))
-            time.sleep(credentials.delay)
+            if not sleepWithin(credentials.delay):
+                logging.warning('{0} does not search Play, the crawl budget ends first'.format(credentials.androidId))
+                return filenames
 
             if 'com.android.vending' in self.report.getAllApkIds():
                 for storeApk in self.report.dAllApks['com.android.vending']:
@@ -115,7 +122,7 @@ class PlayStoreCrawler(object):
                                                  )
                             filenames.append(self.downloadApk(avi, credentials.delay + random.randint(0, credentials.delay), agentvername=storeApk.ver, agentvercode=str(storeApk.vercode), devicename=devicename))
                             logging.info('{0} pauses {1} seconds before continuing'.format(credentials.androidId, credentials.delay))
-                            time.sleep(credentials.delay)
+                            sleepWithin(credentials.delay)
                     except:
                         logging.exception('!!! playstore.playUpdate({0}, {1}) exception ...'.format(storeApk.ver, storeApk.vercode))
                     # END: try
@@ -127,6 +134,8 @@ class PlayStoreCrawler(object):
             res = playstore.bulkDetails(self.report.getAllApkIds(playstoreCaps=True), credentials.sdk)
 
             if res and res.status_code == http.client.OK and res.body:
+                avis        = []
+                uploadDates = {}
                 for app in res.body.entry:
                     if app.doc and app.doc.docid:
                         avi = ApkVersionInfo(name        =app.doc.docid,
@@ -134,14 +143,19 @@ class PlayStoreCrawler(object):
                                              download_src=playstore,
                                              crawler_name=self.__class__.__name__
                                              )
-                        if self.report.isThisApkNeeded(avi):
-                            logging.debug('{0} Update {1}-{2} (Uploaddate {3})'.format(playstore.androidId, avi.name, avi.vercode, app.doc.details.appDetails.uploadDate))
-                            filenames.append(self.downloadApk(avi, credentials.delay + random.randint(0, credentials.delay)))
-                        else:
-                            logging.debug('{0} Skip {1}-{2} (Uploaddate {3})'.format(playstore.androidId, avi.name, avi.vercode, app.doc.details.appDetails.uploadDate))
+                        avis.append(avi)
+                        uploadDates[id(avi)] = app.doc.details.appDetails.uploadDate
                     else:
                         logging.debug('{0} Empty search entry'.format(playstore.androidId))
                         continue
+
+                # Check all entries in one batch
+                (needed, rejected) = self.report.filterNeeded(avis)
+                for (avi, reason) in rejected:
+                    logging.debug('{0} Skip {1}-{2} (Uploaddate {3}): {4}'.format(playstore.androidId, avi.name, avi.vercode, uploadDates[id(avi)], reason))
+                for avi in needed:
+                    logging.debug('{0} Update {1}-{2} (Uploaddate {3})'.format(playstore.androidId, avi.name, avi.vercode, uploadDates[id(avi)]))
+                    filenames.append(self.downloadApk(avi, credentials.delay + random.randint(0, credentials.delay)))
             else:
                 logging.error('{0} Error querying Play Store, status {1}: {2}'.format(playstore.androidId, credentials.sdk, res.status_code))
                 return None  # Not found, return empty
@@ -171,7 +185,9 @@ class PlayStoreCrawler(object):
                 return
 
             logging.info('{0} downloads "{1}" in {2} seconds'.format(avi.download_src.androidId, apkname, delay))
-            time.sleep(delay)
+            if not sleepWithin(delay):
+                logging.warning('{0} does not download {1}, the crawl budget ends first'.format(avi.download_src.androidId, apkname))
+                return
 
             # File might have been dowloaded during our wait, check again
             if os.path.exists(apkname):
@@ -186,30 +202,34 @@ class PlayStoreCrawler(object):
                 logging.info('{0} File {1} already exists (in ../apkcrawler/)'.format(avi.download_src.androidId, apkname))
                 return
 
-            for x in range(1, 4):  # up to three tries
-                res = avi.download_src.download(avi.name, avi.vercode, Global.offerType, agentvername, agentvercode, devicename)
-                if res.body:
-                    with open(apkname, 'wb') as local_file:
-                        local_file.write(res.body)
-                    logging.debug(('beta:' if isBeta else 'reg :') + apkname)
-                    return       (('beta:' if isBeta else ''     ) + apkname)
-                elif res.status_code == http.client.SERVICE_UNAVAILABLE:
-                    wait = delay * x
-                    logging.info('{0} too many sequential requests on the Play Store (503) downloading {1}: waiting {2} seconds'.format(avi.download_src.androidId, apkname, wait))
-                    time.sleep(wait)  # wait longer with each failed try
-                    continue
-                elif res.status_code == http.client.FORBIDDEN:
-                    logging.error('{0} dowloading {1} is forbidden (403)'.format(avi.download_src.androidId, apkname))
-                    return  # Nope, won't happen
-                else:
-                    logging.error('{0} downloading {1} returned unknown HTTP status {2}'.format(avi.download_src.androidId, apkname, res.status_code))
-                    return  # Nope, won't happen
-            else:
+            if not claimDownload(avi):
+                return
+
+            # Each request of the download is retried on 503 (and other transient errors) by httphelper
+            res = avi.download_src.download(avi.name, avi.vercode, offerType, agentvername, agentvercode, devicename, readChunk)
+            if res.body:
+                if not saveDownload(apkname, res.body):
+                    releaseDownload(avi)
+                    return
+                self.report.recordDownload(avi)
+                streamDownload(apkname, avi, isBeta)
+                logging.debug(('beta:' if isBeta else 'reg :') + apkname)
+                return       (('beta:' if isBeta else ''     ) + apkname)
+            elif res.status_code == http.client.SERVICE_UNAVAILABLE:
                 logging.error('{0} downloading {1} failed with repetitive 503 errors'.format(avi.download_src.androidId, apkname))
+                releaseDownload(avi)
                 return  # Kept receiving 503, return empty
-            # END: for x
+            elif res.status_code == http.client.FORBIDDEN:
+                logging.error('{0} dowloading {1} is forbidden (403)'.format(avi.download_src.androidId, apkname))
+                releaseDownload(avi)
+                return  # Nope, won't happen
+            else:
+                logging.error('{0} downloading {1} returned unknown HTTP status {2}'.format(avi.download_src.androidId, apkname, res.status_code))
+                releaseDownload(avi)
+                return  # Nope, won't happen
 
         except OSError:
+            releaseDownload(avi)
             logging.exception('!!! Filename is not valid: "{0}"'.format(apkname))
             return
     # END: def downloadApk
@@ -223,9 +243,9 @@ class PlayStoreCrawler(object):
             path += '/'
         credentialsfile = path + os.path.splitext(os.path.basename(__file__))[0] + '.config'
         stores = getCredentials(credentialsfile)
-        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5)  # Run only 5 tasks before re-creating the process
-        r = p.map_async(unwrap_self_checkPlayStore, list(zip([self] * len(stores), stores)), callback=unwrap_callback)
-        r.wait()
+        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5, initializer=unwrap_init, initargs=(self,))  # Run only 5 tasks before re-creating the process
+        (results, self.skipped) = mapWithinBudget(p, unwrap_self_checkPlayStore, stores, self.__class__.__name__)
+        unwrap_callback(results)
         (self.dlFiles, self.dlFilesBeta) = unwrap_getresults()
     # END: crawl():
 # END: class PlayStoreCrawler
@@ -312,6 +332,7 @@ def updateTokenCredentials(credentialsfile, androidId, sdk, delay, email, passwo
 
 nonbeta = []
 beta    = []
+worker  = None  # the crawler in a pool process, see unwrap_init()
 
 
 def unwrap_callback(results):
@@ -331,8 +352,15 @@ def unwrap_getresults():
     return (nonbeta, beta)
 
 
-def unwrap_self_checkPlayStore(arg, **kwarg):
-    return PlayStoreCrawler.checkPlayStore(*arg, **kwarg)
+def unwrap_init(crawler):
+    global worker
+    worker = crawler
+
+
+def unwrap_self_checkPlayStore(arg):
+    if worker.report.isSatisfied():  # Nothing left to find
+        return None
+    return worker.checkPlayStore(arg)
 
 
 if __name__ == "__main__":
@@ -342,30 +370,34 @@ if __name__ == "__main__":
     logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    lines = ''
-    if len(sys.argv[1:]) == 1:
-        with open(sys.argv[1]) as report:
-            lines = report.readlines()
+    if len(sys.argv[1:]) == 1 and os.path.isdir(sys.argv[1]):
+        report = buildReport(sys.argv[1])
+    elif len(sys.argv[1:]) == 1:
+        with open(sys.argv[1]) as lines:
+            report = loadReport(lines)
     else:
-        lines = sys.stdin.readlines()
-
-    report = ReportHelper(lines)
+        report = loadReport(sys.stdin)
 
     if len(list(report.getAllApkIds())) == 0:
         print('ERROR: expecting:')
         print(' - 1 parameter (report file from output of report_sources.sh)')
         print(' or ')
+        print(' - 1 parameter (Open GApps sources directory)')
+        print(' or ')
         print(' - stdin from report_sources.sh')
         exit(1)
 
     crawler = PlayStoreCrawler(report)
-    crawler.crawl()
+    openStream()  # Before the pool forks, so all its workers share the stream
+    with claimRun():
+        crawler.crawl()
+        logMetrics()
 
     outputString = ' '.join(crawler.dlFiles)
     if crawler.dlFilesBeta:
         outputString += ' beta ' + ' '.join(crawler.dlFilesBeta)
 
-    if outputString:
+    if outputString and not isStreamingStdout():
         print(outputString)
         sys.stdout.flush()
 
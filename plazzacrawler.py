@@ -12,14 +12,20 @@ import logging
 import multiprocessing
 import os
 import re
-import requests
 import sys
 import unicodedata
 
+import requests
 from bs4 import BeautifulSoup
 from debug import Debug
 from apkhelper import ApkVersionInfo
-from reporthelper import ReportHelper
+from claimhelper import claimDownload, claimRun, releaseDownload, saveDownload
+from httphelper import getSession
+from retryhelper import logMetrics
+from timeouthelper import getTimeout, mapWithinBudget
+from streamhelper import isStreamingStdout, openStream, streamDownload
+from reportbuilder import buildReport
+from reporthelper import ReportHelper, loadReport
 
 ###################
 # DEBUG VARS      #
@@ -48,6 +54,7 @@ class PlazzaCrawler(object):
         self.report      = report
         self.dlFiles     = dlFiles
         self.dlFilesBeta = dlFilesBeta
+        self.skipped     = []  # What was not checked within the crawl budget, see mapWithinBudget()
 
     def downloadApk(self, avi, isBeta=False):
         """
@@ -70,17 +77,26 @@ class PlazzaCrawler(object):
                 logging.info('{0} already exists (in ../apkcrawler/)'.format(apkname))
                 return
 
+            if not claimDownload(avi):
+                return
+
             # Open the url
-            session = requests.Session()
+            session = getSession(avi.download_src, self.__class__.__name__)
 
-            r = session.get(avi.download_src, stream=True)  # plazza blocks fetching it at one go, we need to stream it in chunks
-            with open(apkname, 'wb') as local_file:
-                for chunk in r.iter_content(1024):
-                    local_file.write(chunk)
+            r = session.get(avi.download_src, stream=True, timeout=getTimeout('download'))  # plazza blocks fetching it at one go, we need to stream it in chunks
+            if not saveDownload(apkname, r.iter_content(1024)):
+                releaseDownload(avi)
+                return
 
+            self.report.recordDownload(avi)
+            streamDownload(apkname, avi, isBeta)
             logging.debug(('beta:' if isBeta else 'reg :') + apkname)
             return       (('beta:' if isBeta else ''     ) + apkname)
+        except requests.exceptions.RequestException as e:  # e.g. a read or the total timeout mid-stream
+            releaseDownload(avi)
+            logging.error('!!! Failed to download {0}: {1}'.format(apkname, e))
         except OSError:
+            releaseDownload(avi)
             logging.exception('!!! Filename is not valid: "{0}"'.format(apkname))
     # END: def downloadApk
 
@@ -92,10 +108,10 @@ class PlazzaCrawler(object):
 
         url       = 'http://www.plazza.ir/app/' + apkid + '?hl=en'
 
-        session = requests.Session()
+        session = getSession(url, self.__class__.__name__)
         logging.debug('Requesting: ' + url)
         try:
-            resp    = session.get(url, allow_redirects=False)  # we get a 302 if application is not found
+            resp    = session.get(url, allow_redirects=False, timeout=getTimeout('listing'))  # we get a 302 if application is not found
             if resp.status_code == http.client.OK:
                 html    = unicodedata.normalize('NFKD', resp.text).encode('ascii', 'ignore')
 
@@ -104,7 +120,7 @@ class PlazzaCrawler(object):
                     latesthref = dom.find('a', {'itemprop': 'downloadUrl'})['href']
                     latestver = dom.find('div', {'itemprop': 'softwareVersion'}).contents[0].strip()
                     appid     = re.search('(^\/dl\/)([0-9]+)(\/1$)', latesthref).group(2)
-                    latesturl = session.head('http://www.plazza.ir' + latesthref, allow_redirects=True).url
+                    latesturl = session.head('http://www.plazza.ir' + latesthref, allow_redirects=True, timeout=getTimeout('detail')).url
                     # latestvercode = re.search('(_)([0-9]+)(\.apk)$', latesturl).group(2) #apparently this is NOT a (reliable?) versioncode
                     avi = ApkVersionInfo(name=apkid,
                                          ver=latestver,
@@ -135,15 +151,16 @@ class PlazzaCrawler(object):
         crawl(): check all plazza apps
         """
         # Start checking all apkids ...
-        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5)  # Run only 5 tasks before re-placing the process
-        r = p.map_async(unwrap_self_checkOneApp, list(zip([self] * len(list(self.report.getAllApkIds())), list(self.report.getAllApkIds()))), callback=unwrap_callback)
-        r.wait()
+        p = multiprocessing.Pool(processes=threads, maxtasksperchild=5, initializer=unwrap_init, initargs=(self,))  # Run only 5 tasks before re-placing the process
+        (results, self.skipped) = mapWithinBudget(p, unwrap_self_checkOneApp, list(self.report.getAllApkIds()), self.__class__.__name__)
+        unwrap_callback(results)
         (self.dlFiles, self.dlFilesBeta) = unwrap_getresults()
     # END: crawl():
 # END: class PlazzaCrawler
 
 nonbeta = []
 beta    = []
+worker  = None  # the crawler in a pool process, see unwrap_init()
 
 
 def unwrap_callback(results):
@@ -159,8 +176,15 @@ def unwrap_getresults():
     return (nonbeta, beta)
 
 
-def unwrap_self_checkOneApp(arg, **kwarg):
-    return PlazzaCrawler.checkOneApp(*arg, **kwarg)
+def unwrap_init(crawler):
+    global worker
+    worker = crawler
+
+
+def unwrap_self_checkOneApp(arg):
+    if worker.report.isSatisfied():  # Nothing left to find
+        return None
+    return worker.checkOneApp(arg)
 
 
 if __name__ == "__main__":
@@ -170,30 +194,34 @@ if __name__ == "__main__":
     logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    lines = ''
-    if len(sys.argv[1:]) == 1:
-        with open(sys.argv[1]) as report:
-            lines = report.readlines()
+    if len(sys.argv[1:]) == 1 and os.path.isdir(sys.argv[1]):
+        report = buildReport(sys.argv[1])
+    elif len(sys.argv[1:]) == 1:
+        with open(sys.argv[1]) as lines:
+            report = loadReport(lines)
     else:
-        lines = sys.stdin.readlines()
-
-    report = ReportHelper(lines)
+        report = loadReport(sys.stdin)
 
     if len(list(report.getAllApkIds())) == 0:
         print('ERROR: expecting:')
         print(' - 1 parameter (report file from output of report_sources.sh)')
         print(' or ')
+        print(' - 1 parameter (Open GApps sources directory)')
+        print(' or ')
         print(' - stdin from report_sources.sh')
         exit(1)
 
     crawler = PlazzaCrawler(report)
-    crawler.crawl()
+    openStream()  # Before the pool forks, so all its workers share the stream
+    with claimRun():
+        crawler.crawl()
+        logMetrics()
 
     outputString = ' '.join(crawler.dlFiles)
     if crawler.dlFilesBeta:
         outputString += ' beta ' + ' '.join(crawler.dlFilesBeta)
 
-    if outputString:
+    if outputString and not isStreamingStdout():
         print(outputString)
         sys.stdout.flush()
 
@@ -0,0 +1,210 @@
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+
+# Token bucket of each host: requests per second, adjusted by AIMD (additive increase after
+# each good response, multiplicative decrease when the host signals it is overloaded)
+initialRate  = float(os.environ.get('APKCRAWLER_RATE', 5.0))
+minRate      = 0.2   # Never slower than one request per 5 seconds
+maxRate      = 50.0
+rateIncrease = 0.5   # Requests per second added per second of good responses, however many
+                     # processes share the host
+rateDecrease = 0.5   # Factor applied to the rate on 429/503/connection reset
+burst        = 2.0   # Tokens a host can save up while idle
+throttleHold = 1.0   # Seconds after a decrease in which more pushback (of requests that were
+                     # already in flight) does not decrease the rate again
+
+# Hosts known to want a gentler start than initialRate
+allHostRates = {
+    'apkbeast.com'    : 1.0,  # APKBeast kills the connection if hit too hard
+    'ws75.aptoide.com': 1.0,  # Aptoide answers 503 to many sequential requests
+}
+
+# The buckets are shared by all processes (crawler pool workers and concurrent crawls) on this
+# machine: one small file per host, mapped into memory and updated under flock()
+rateDir      = os.environ.get('APKCRAWLER_RATES',
+                              os.path.join(tempfile.gettempdir(), 'apkcrawler-rates-{0}'.format(os.getuid())))
+rateMemory   = 600.0  # Seconds a host must be idle before its bucket starts over at its initial rate
+bucketFormat = struct.Struct('<dddd')  # rate, tokens, stamp and last decrease, in time.monotonic()
+                                       # which is the same in all processes
+
+reUnsafe = re.compile('[^A-Za-z0-9._-]')
+
+hostsLock = threading.Lock()
+hosts     = {}    # TokenBucket by host, see getBucket()
+hostsPid  = None  # Process that owns hosts; a forked worker opens its own
+
+
+class SharedStruct(object):
+    """
+    SharedStruct: The values of structFormat kept in the file path, mapped into memory and
+                  updated under flock() by all processes that open it; all zero when new
+                  Without a path the values are only shared with the threads of this process
+    """
+    __slots__ = ['format', 'fd', 'map', 'lock']
+
+    def __init__(self, path, structFormat):
+        self.format = structFormat
+        self.fd     = None
+        self.lock   = threading.Lock()  # flock() does not exclude the threads of one process
+
+        if path is None:
+            self.map = mmap.mmap(-1, structFormat.size)
+            return
+
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < structFormat.size:
+                os.ftruncate(self.fd, structFormat.size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.fd, structFormat.size)
+
+    def close(self):
+        """
+        def close(): Unmap and close the file (of this process)
+        """
+        self.map.close()
+        if self.fd is not None:
+            os.close(self.fd)
+    # END: def close
+
+    @contextlib.contextmanager
+    def values(self):
+        """
+        def values(): Context giving the values as a list, exclusively for all processes;
+                      changes are written back on exit
+        """
+        with self.lock:
+            if self.fd is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                current = list(self.format.unpack_from(self.map))
+                yield current
+                self.format.pack_into(self.map, 0, *current)
+            finally:
+                if self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+    # END: def values
+# END: class SharedStruct
+
+
+class TokenBucket(object):
+    __slots__ = ['host', 'initial', 'shared']
+
+    def __init__(self, host, rate):
+        self.host    = host
+        self.initial = rate
+        self.shared  = SharedStruct(os.path.join(rateDir, reUnsafe.sub('_', host)), bucketFormat)  # all zero: a new bucket, see state()
+
+    def close(self):
+        """
+        def close(): Unmap and close the bucket file (of this process)
+        """
+        self.shared.close()
+    # END: def close
+
+    @contextlib.contextmanager
+    def state(self):
+        """
+        def state(): Context giving [rate, tokens, stamp, throttled] with the tokens refilled up
+                     to now, exclusively for all processes; changes are written back on exit
+        """
+        with self.shared.values() as current:
+            (rate, tokens, stamp, throttled) = current
+            now = time.monotonic()
+            if rate <= 0.0 or not 0.0 <= now - stamp <= rateMemory:
+                (rate, tokens, stamp, throttled) = (self.initial, 1.0, now, 0.0)
+            current[:] = [rate, min(burst, tokens + (now - stamp) * rate), now, throttled]
+            yield current
+    # END: def state
+
+    def reserve(self):
+        """
+        def reserve(): Take a token and return the seconds to wait before it may be used
+        """
+        with self.state() as current:
+            current[1] -= 1.0
+            return 0.0 if current[1] >= 0.0 else -current[1] / current[0]
+    # END: def reserve
+
+    def relax(self):
+        """
+        def relax(): Additive increase after a good response; at rate requests per second the
+                     rate grows by rateIncrease each second
+        """
+        with self.state() as current:
+            current[0] = min(maxRate, current[0] + rateIncrease / current[0])
+    # END: def relax
+
+    def throttle(self, reason):
+        """
+        def throttle(): Multiplicative decrease when the host pushes back; tokens already
+                        saved up are dropped so the next request waits for the new rate
+        """
+        with self.state() as current:
+            if current[2] - current[3] < throttleHold:
+                return
+            current[0] = max(minRate, current[0] * rateDecrease)
+            current[1] = min(current[1], 0.0)
+            current[3] = current[2]
+            rate       = current[0]
+        logging.info('{0} ({1}): slowing down to {2:.2f} requests/second'.format(self.host, reason, rate))
+    # END: def throttle
+# END: class TokenBucket
+
+
+def getBucket(host):
+    """
+    getBucket(host): The TokenBucket of host
+    """
+    global hostsPid
+    with hostsLock:
+        if hostsPid != os.getpid():
+            # The bucket files of the parent process share its flock(), so open them anew
+            for bucket in hosts.values():
+                bucket.close()
+            hosts.clear()
+            hostsPid = os.getpid()
+
+        bucket = hosts.get(host)
+        if bucket is None:
+            bucket = hosts[host] = TokenBucket(host, allHostRates.get(host, initialRate))
+        return bucket
+# END: def getBucket
+
+
+def waitForHost(host):
+    """
+    waitForHost(host): Block until the next request to host is allowed
+    """
+    wait = getBucket(host).reserve()
+    if wait > 0.0:
+        time.sleep(wait)
+# END: def waitForHost
+
+
+def relaxHost(host):
+    """
+    relaxHost(host): Report a good response of host, so its rate goes up
+    """
+    getBucket(host).relax()
+# END: def relaxHost
+
+
+def throttleHost(host, reason):
+    """
+    throttleHost(host, reason): Report that host is overloaded (429, 503, connection reset),
+                                so its rate goes down
+    """
+    getBucket(host).throttle(reason)
+# END: def throttleHost
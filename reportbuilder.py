@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+#
+# Builds the report of an Open GApps sources tree natively, instead of parsing
+# the output of report_sources.sh
+#
+# Usage: ./reportbuilder.py <sources directory>   (prints a report_sources.sh style report)
+#
+
+import logging
+import multiprocessing
+import os
+import pickle
+import struct
+import sys
+import zipfile
+
+from debug import Debug
+from apkhelper import ApkVersionInfo
+from reporthelper import ReportHelper
+
+###################
+# Globals         #
+###################
+
+# Manifest information per APK, keyed by path and only valid for the same size and mtime
+sourcesCacheFile    = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reportbuilder.cache')
+sourcesCacheVersion = 1  # Bump when the layout of the cache entries changes
+
+# logging
+logFile   = '{0}.log'.format(os.path.basename(__file__))
+logLevel  = (logging.DEBUG if Debug.DEBUG else logging.INFO)
+logFormat = '%(asctime)s %(levelname)s/%(funcName)s(%(process)-5d): %(message)s'
+
+# Binary XML (AXML) chunk types and android: attribute resource ids
+AXML_STRING_POOL   = 0x0001
+AXML_RESOURCE_MAP  = 0x0180
+AXML_START_ELEMENT = 0x0102
+AXML_UTF8_FLAG     = 0x0100
+AXML_TYPE_STRING   = 0x03
+AXML_NO_INDEX      = 0xFFFFFFFF
+
+manifestAttrIds = {0x0101021b: 'versionCode',
+                   0x0101021c: 'versionName'}
+
+
+def readAxmlString(data, offset, utf8):
+    """
+    readAxmlString(data, offset, utf8): Decode one string of an AXML string pool
+    """
+    if utf8:
+        # Length in characters, then in bytes; each 1 or 2 bytes
+        offset += 2 if data[offset] & 0x80 else 1
+        length  = data[offset]
+        if length & 0x80:
+            length  = ((length & 0x7F) << 8) | data[offset + 1]
+            offset += 1
+        offset += 1
+        return data[offset:offset + length].decode('utf-8', 'replace')
+    else:
+        length = struct.unpack_from('<H', data, offset)[0]
+        if length & 0x8000:
+            length  = ((length & 0x7FFF) << 16) | struct.unpack_from('<H', data, offset + 2)[0]
+            offset += 2
+        offset += 2
+        return data[offset:offset + length * 2].decode('utf-16-le', 'replace')
+# END: def readAxmlString
+
+
+def readManifest(data):
+    """
+    readManifest(data): Return {'package', 'versionCode', 'versionName'} from the binary
+                        AndroidManifest.xml; only the <manifest> element is parsed
+    """
+    strings = []
+    resIds  = []
+    offset  = 8  # Skip the XML file header
+    while offset + 8 <= len(data):
+        (chunkType, headerSize, chunkSize) = struct.unpack_from('<HHI', data, offset)
+        if chunkSize < 8:
+            break
+
+        if chunkType == AXML_STRING_POOL:
+            (count, styles, flags, stringsStart) = struct.unpack_from('<IIII', data, offset + 8)
+            utf8    = bool(flags & AXML_UTF8_FLAG)
+            starts  = struct.unpack_from('<{0}I'.format(count), data, offset + headerSize)
+            strings = [readAxmlString(data, offset + stringsStart + start, utf8) for start in starts]
+        elif chunkType == AXML_RESOURCE_MAP:
+            resIds = struct.unpack_from('<{0}I'.format((chunkSize - headerSize) // 4), data, offset + headerSize)
+        elif chunkType == AXML_START_ELEMENT:
+            (nameIdx, attrStart, attrSize, attrCount) = struct.unpack_from('<IHHH', data, offset + headerSize + 4)
+            if strings[nameIdx] != 'manifest':
+                break  # <manifest> is always the first element
+
+            manifest = {}
+            for x in range(attrCount):
+                attr = offset + headerSize + attrStart + x * attrSize
+                (nameIdx, rawValue, dataType, value) = struct.unpack_from('<IIxxxBI', data, attr + 4)
+                name = manifestAttrIds.get(resIds[nameIdx] if nameIdx < len(resIds) else None, strings[nameIdx])
+                if rawValue != AXML_NO_INDEX:
+                    manifest[name] = strings[rawValue]
+                elif dataType == AXML_TYPE_STRING:
+                    manifest[name] = strings[value]
+                else:
+                    manifest[name] = value
+            return manifest
+
+        offset += chunkSize
+    # END: while offset
+    raise ValueError('No <manifest> element found')
+# END: def readManifest
+
+
+def readApkInfo(apkfile):
+    """
+    readApkInfo(apkfile): Return (apkfile, (package, versionName, versionCode)) of an APK,
+                          or (apkfile, None) if it cannot be read
+    """
+    try:
+        with zipfile.ZipFile(apkfile) as apk:
+            manifest = readManifest(apk.read('AndroidManifest.xml'))
+        versionName = manifest.get('versionName', '')
+        if not isinstance(versionName, str):  # A resource reference, only aapt can resolve that
+            logging.warning('{0}: versionName is not a plain string'.format(apkfile))
+            versionName = ''
+        return (apkfile, (manifest.get('package', ''), versionName, str(manifest.get('versionCode', ''))))
+    except Exception:
+        logging.exception('!!! Unable to read manifest of: "{0}"'.format(apkfile))
+        return (apkfile, None)
+# END: def readApkInfo
+
+
+def scanSources(sourcesdir):
+    """
+    scanSources(sourcesdir): Return (path, arch, package, sdk, dpi, size, mtime) of all APKs in an
+                             Open GApps sources tree: <arch>/<type>/<package>/<sdk>/<dpi>/*.apk
+    """
+    apks = []
+    for (dirpath, dirnames, filenames) in os.walk(sourcesdir):
+        dirnames.sort()
+        parts = os.path.relpath(dirpath, sourcesdir).split(os.sep)
+        if len(parts) < 5:
+            continue
+        for filename in sorted(filenames):
+            if filename.endswith('.apk'):
+                path = os.path.join(dirpath, filename)
+                st   = os.stat(path)
+                apks.append((path, parts[0], parts[-3], parts[-2], parts[-1], st.st_size, st.st_mtime_ns))
+    return apks
+# END: def scanSources
+
+
+def loadSourcesCache(cachefile):
+    """
+    loadSourcesCache(cachefile): Return {path: (size, mtime, info)} as stored by buildReport()
+    """
+    if cachefile and os.path.isfile(cachefile):
+        try:
+            with open(cachefile, 'rb') as cache_file:
+                (version, cache) = pickle.load(cache_file)
+            if version == sourcesCacheVersion:
+                return cache
+        except Exception:
+            logging.exception('!!! Ignoring unreadable sources cache: "{0}"'.format(cachefile))
+    return {}
+# END: def loadSourcesCache
+
+
+def saveSourcesCache(cachefile, cache):
+    """
+    saveSourcesCache(cachefile, cache): Atomically replace cachefile with cache
+    """
+    try:
+        tmpfile = '{0}.{1}'.format(cachefile, os.getpid())
+        with open(tmpfile, 'wb') as cache_file:
+            pickle.dump((sourcesCacheVersion, cache), cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+    except OSError:
+        logging.exception('!!! Unable to write sources cache: "{0}"'.format(cachefile))
+# END: def saveSourcesCache
+
+
+def readSources(sourcesdir, cachefile=sourcesCacheFile, processes=None):
+    """
+    readSources(sourcesdir, cachefile, processes): Return (arch, package, sdk, dpi, size, info) for all
+                                                   APKs in sourcesdir; only new or changed APKs
+                                                   (by size and mtime) are read, in a process pool
+    """
+    apks  = scanSources(sourcesdir)
+    cache = loadSourcesCache(cachefile)
+
+    todo = [apk[0] for apk in apks if cache.get(apk[0], (None, None))[0:2] != (apk[5], apk[6])]
+    logging.info('{0} APKs in {1}, {2} new or changed'.format(len(apks), sourcesdir, len(todo)))
+
+    infos = {}
+    if todo:
+        p = multiprocessing.Pool(processes=processes)
+        for (apkfile, info) in p.imap_unordered(readApkInfo, todo, chunksize=16):
+            infos[apkfile] = info
+        p.close()
+        p.join()
+
+    newCache = {}
+    sources  = []
+    for (path, arch, package, sdk, dpi, size, mtime) in apks:
+        info = infos[path] if path in infos else cache[path][2]
+        newCache[path] = (size, mtime, info)
+        if info:
+            # Named by its directory, as report_sources.sh does: variants such as .leanback or
+            # .beta have the package of the base app in their manifest
+            sources.append((arch, package, sdk, dpi, size, info))
+
+    if cachefile and (todo or len(newCache) != len(cache)):
+        saveSourcesCache(cachefile, newCache)
+    return sources
+# END: def readSources
+
+
+def buildReport(sourcesdir, cachefile=sourcesCacheFile, processes=None):
+    """
+    buildReport(sourcesdir, cachefile, processes): Return a ReportHelper for an Open GApps sources tree,
+                                                   as ReportHelper(report_sources.sh output) would
+    """
+    avis = (ApkVersionInfo(name=name, arch=arch, sdk=sdk, dpi=dpi, ver=info[1], vercode=info[2])
+            for (arch, name, sdk, dpi, size, info) in readSources(sourcesdir, cachefile, processes))
+    return ReportHelper(avis=avis)
+# END: def buildReport
+
+
+if __name__ == "__main__":
+    """
+    main(): single parameter for the sources directory, prints a report_sources.sh style report
+    """
+    logging.basicConfig(filename=logFile, filemode='w', level=logLevel, format=logFormat)
+
+    if len(sys.argv[1:]) != 1 or not os.path.isdir(sys.argv[1]):
+        print('ERROR: expecting 1 parameter (Open GApps sources directory)')
+        exit(1)
+
+    for (arch, name, sdk, dpi, size, info) in readSources(sys.argv[1]):
+        print('  {0:<45}|{1:<7}|{2:<4}|{3:<12}|{4:<30}|{5:<10}|{6:<6}|'.format(
+              name, arch, sdk, dpi, info[1], info[2], '{0:.1f}'.format(size / 1048576)))
@@ -1,37 +1,166 @@
+#!/usr/bin/env python3
+
+import gc
+import hashlib
+import itertools
+import json
 import logging
+import os
+import pickle
 import re
-from apkhelper import ApkVersionInfo
+import sys
+import tempfile
+
+import apkhelper
+from apkhelper import ApkVersionInfo, verKey
+from claimhelper import getSatisfied, getSatisfiedKey, markSatisfied
+
+# Parsed reports are cached here, keyed by a hash of the report content (see loadReport)
+reportCacheFile    = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reporthelper.cache')
+reportCacheVersion = 7  # Bump when the layout of ReportHelper changes
+
+# The columns of a report_sources.sh line
+reportColumns = ['name', 'arch', 'sdk', 'dpi', 'ver', 'code', 'mib', 'sig']
+sColumns      = ['(?P<name>[a-z][^|]*)', '(?P<arch>[^|]*)', '(?P<sdk>[^|]*)', '(?P<dpi>[^|]*)',
+                 '(?P<ver>[^|]*)',       '(?P<code>[^|]*)', '(?P<mib>[^|]*)', '(?P<sig>[^|]*)']
+reReportLine  = re.compile('^\s+' + '\|'.join(sColumns) + '$')
+
+# NDJSON reports start with this header line, followed by one JSON array per APK in the order
+# of its "columns"; see convertReport()
+reportJsonFormat = 'apkcrawler-report'
+reportJsonChunk  = 1000  # Rows decoded per json.loads() call
+
+# Reasons returned by ReportHelper.getNotNeededReason() and filterNeeded()
+allNotNeededReasons = ['NotInReport',       # Not an APK we track
+                       'HaveVercode',       # Already have this vercode
+                       'HaveHigherVercode', # Already have an equal or higher vercode of a one-variant app
+                       'HaveRealver',       # Already have this realver of a one-variant/one-vercode app
+                       'OlderThanMax',      # Older than the newest version we have
+                       'SdkNotNumber',      # Preview SDK
+                       'TargetNotNumber',   # Preview target SDK
+                       'SdkTooLow',         # Below the minimum SDK we support for this APK
+                       'HaveBetaVercode',   # Already have this vercode as beta
+                       'NotNewerThanBeta',  # Not newer than the beta we have
+                       'DuplicateInBatch']  # filterNeeded(): an earlier candidate of the batch has this vercode (or realver)
+
+# Report rows are added in batches of this size, so rankVersions() finds the max version of
+# each APK once per batch instead of comparing every row on its own
+reportBatchRows = 1000
+
+# Vercodes of factory image files, which are not part of the report
+factoryVercodes = frozenset([1, 19, 21, 22, 23, 24, 25, 26, 27, 28, 29])
+
+
+def rankVersions(avisByName, maxKeys=None):
+    """
+    rankVersions(avisByName, maxKeys): Rank the versions of many packages in one pass
+                                       Every distinct version string is converted once into a row
+                                       of a zero padded integer matrix; rows of equal width compare
+                                       directly, so per package max, ranks and masks need no further
+                                       pairwise ApkVersionInfo comparisons
+                                       Returns {name: {'max': ver, 'maxKey': key, 'ranks': [...], 'older': [...]}}
+                                       where max is the first of the newest versions, maxKey its verKey,
+                                       ranks (0 is newest) and older (older than max) follow the input order
+                                       With maxKeys ({name: verKey}, e.g. the max of a report when ranking
+                                       crawl results) older marks the versions older than that key instead
+    """
+    # Build the version matrix over all distinct version strings
+    keys = {}
+    for avis in avisByName.values():
+        for avi in avis:
+            if avi.ver not in keys:
+                keys[avi.ver] = verKey(avi.ver)
+    maxKeys = maxKeys or {}
+    width   = max([len(key) for key in keys.values()] + [len(maxKeys[name]) for name in avisByName if name in maxKeys] + [0])
+    matrix  = {ver: key + (0,) * (width - len(key)) for ver, key in keys.items()}
+
+    ranking = {}
+    for name, avis in avisByName.items():
+        rows = [matrix[avi.ver] for avi in avis]
+        if not rows:
+            continue
+
+        # max() returns the first of equal rows, as the pairwise comparison did
+        maxRow   = max(rows)
+        maxVer   = avis[rows.index(maxRow)].ver
+        rankRows = {row: rank for rank, row in enumerate(sorted(set(rows), reverse=True))}
+        if name in maxKeys:
+            olderRow = maxKeys[name] + (0,) * (width - len(maxKeys[name]))
+        else:
+            olderRow = maxRow
+
+        ranking[name] = {'max'   : maxVer,
+                         'maxKey': keys[maxVer],
+                         'ranks' : [rankRows[row] for row in rows],
+                         'older' : [row < olderRow for row in rows]}
+    # END: for name
+    return ranking
+# END: def rankVersions
 
 
 class ReportHelper(object):
     """ReportHelper"""
-    def __init__(self, lines):
+    def __init__(self, lines=(), avis=()):
+        """
+        ReportHelper(lines, avis): lines can be any iterable of report lines (e.g. an open file or
+                                   sys.stdin) and avis any iterable of ApkVersionInfo (see
+                                   reportbuilder.py); both are consumed in a single pass and all
+                                   per APK aggregates are updated as the rows arrive
+                                   The report is only usable once all lines are read: whether an
+                                   APK is needed depends on all of its rows, so the crawlers start
+                                   after that (the rows are not kept in memory as lines meanwhile)
+        """
         self.dAllApks      = {}
         self.maxVerEachApk = {}
         self.minSdkEachApk = {}
         self.appsNeeded    = []
 
+        # Archs of each APK that showMissingApks() found outdated; with stopWhenSatisfied the
+        # crawlers stop once recordDownload() fulfilled all of them (see isSatisfied)
+        self.needsEachApk      = {}
+        self.stopWhenSatisfied = False
+
+        # Per APK indexes for isThisApkNeeded()
+        self.vercodesEachApk   = {}
+        self.maxVercodeEachApk = {}
+        self.realversEachApk   = {}
+        self.maxVerKeyEachApk  = {}
+        self.betaEachApk       = {}
+
+        # Per APK variant matrix for fillsVariantGap(): {(arch, sdk, dpi): max full version key}
+        self.variantsEachApk   = {}
+
+        # Memoized getAllApkIds() views, cleared when an APK id is added
+        self.apkIdsCache       = {}
+
+        # Memoized getNotNeededReason() decisions, cleared by recordDownload()
+        self.neededCache       = {}
+        self.neededCacheHits   = 0
+        self.neededCacheMisses = 0
+
         # Fill member dict and lists
         self.processReportSourcesOutput(lines)
-        self.getMaxVersionDict()
-        self.getMinSdkDict()
+        avis = iter(avis)
+        for batch in iter(lambda: list(itertools.islice(avis, reportBatchRows)), []):
+            self.addApks(batch)
         self.showMissingApks()
     # END: __init__
 
     def processReportSourcesOutput(self, lines):
         """
         processReportSourcesOutput(lines): Populate a dictionary of all APKs and versions in report
-                                           created by report_sources.sh
+                                           created by report_sources.sh, one line at a time
+                                           (added reportBatchRows at a time, see addApks)
+                                           An NDJSON header line switches to processReportJson()
         """
-        self.dAllApks = {}
-
-        sColumns = ['(?P<name>[a-z][^|]*)', '(?P<arch>[^|]*)', '(?P<sdk>[^|]*)', '(?P<dpi>[^|]*)',
-                    '(?P<ver>[^|]*)',       '(?P<code>[^|]*)', '(?P<mib>[^|]*)', '(?P<sig>[^|]*)']
-        pattern  = '^\s+' + '\|'.join(sColumns) + '$'
-        reLine   = re.compile(pattern)
-
+        batch = []
+        lines = iter(lines)
         for line in lines:
-            m = reLine.match(line)
+            if line.startswith('{'):
+                self.processReportJson(line, lines)
+                break
+
+            m = reReportLine.match(line)
             if m:
                 name = m.group('name').strip()
                 arch = m.group('arch').strip()
@@ -45,85 +174,157 @@ class ReportHelper(object):
                                       dpi=dpi,
                                       ver=ver,
                                       vercode=code)
+                batch.append(avi)
+                if len(batch) == reportBatchRows:
+                    self.addApks(batch)
+                    batch = []
+            # END: if m:
+        # END: for line
+        self.addApks(batch)
+    # END: def processReportSourcesOutput
 
-                # Check if supported and add if it is
-                if avi.vercode in [1, 19, 21, 22, 23, 24, 25, 26, 27, 28, 29]:  # Ignore factory image files
-                    continue
+    def processReportJson(self, header, lines):
+        """
+        processReportJson(header, lines): Populate a dictionary of all APKs and versions from the
+                                          rows of an NDJSON report (see convertReport); rows are
+                                          already split and stripped, so no regex is needed and
+                                          they are decoded reportJsonChunk rows per json.loads()
+        """
+        columns = json.loads(header)
+        if columns.get('format') != reportJsonFormat:
+            raise ValueError('Unknown report format: {0}'.format(header.strip()))
+        (iName, iArch, iSdk, iDpi, iVer, iCode) = [columns['columns'].index(c) for c in reportColumns[:6]]
 
-                if avi.name not in list(self.dAllApks.keys()):
-                    self.dAllApks[avi.name] = []
+        chunk = []
+        for line in itertools.chain(lines, [None]):
+            if line is not None:
+                if line.startswith('['):
+                    chunk.append(line)
+                if len(chunk) < reportJsonChunk:
+                    continue
 
-                self.dAllApks[avi.name].append(avi)
-            # END: if m:
+            self.addApks([ApkVersionInfo(name=row[iName],
+                                         arch=row[iArch],
+                                         sdk=row[iSdk],
+                                         dpi=row[iDpi],
+                                         ver=row[iVer],
+                                         vercode=row[iCode]) for row in json.loads('[' + ','.join(chunk) + ']')])
+            chunk = []
         # END: for line
-    # END: def processReportSourcesOutput
+    # END: def processReportJson
 
-    def getAllApkIds(self, beta=False, playstoreCaps=False):
-        apkIds = self.dAllApks.keys()
-        regexStr = '^.*$'
-        if not beta:
-            regexStr = '^.*\.beta$'
-        reBeta = re.compile(regexStr)
-        if playstoreCaps:
-            apkIds = [apkid.replace('googlecamera', 'GoogleCamera') for apkid in apkIds]
-        return list(filter(lambda x: not reBeta.match(x), apkIds))
-    # END: def getAllApkIds
+    def addApk(self, avi):
+        """
+        addApk(avi): Add one APK of the report, see addApks()
+        """
+        self.addApks([avi])
+    # END: def addApk
 
-    def getMaxVersionDict(self):
+    def addApks(self, avis):
         """
-        getMaxVersionDict(): Populate a dictionary of the max version of each APK
+        addApks(avis): Add a batch of APKs of the report and update the per APK aggregates (max
+                       version, min sdk and the indexes used by isThisApkNeeded) incrementally
+                       The max version of each APK in the batch is found by rankVersions() and
+                       then merged with the max so far
         """
-        self.maxVerEachApk = {}
+        byName = {}
+        for avi in avis:
+            # Check if supported and add if it is
+            if avi.vercode in factoryVercodes:  # Ignore factory image files
+                continue
+
+            k = avi.name
+            if k not in self.dAllApks:
+                self.dAllApks[k]          = [avi]
+                self.minSdkEachApk[k]     = min(int(avi.sdk), 19)  # We support down to 19
+                self.vercodesEachApk[k]   = {avi.vercode}
+                self.maxVercodeEachApk[k] = avi.vercode
+                self.realversEachApk[k]   = {avi.realver}
+                self.variantsEachApk[k]   = {}
 
-        for k in sorted(self.dAllApks.keys()):
-            k2 = self.dAllApks[k][0].name
-            if k not in self.maxVerEachApk:
-                max1 = max(apk for apk in self.dAllApks[k]).ver
-                max2 = max1
+                # Link beta and non-beta, whichever comes first
+                if k + '.beta' in self.dAllApks:
+                    self.betaEachApk[k] = k + '.beta'
+                if k.endswith('.beta') and k[:-5] in self.dAllApks:
+                    self.betaEachApk[k[:-5]] = k
 
-                # Check for "non-leanback" versions for max comparison
-                if k2 in self.dAllApks:
-                    max2 = max(apk for apk in self.dAllApks[k2]).ver
+                if self.apkIdsCache:
+                    self.apkIdsCache = {}
+            else:
+                self.dAllApks[k].append(avi)
+                self.minSdkEachApk[k]     = min(self.minSdkEachApk[k], int(avi.sdk))
+                self.vercodesEachApk[k].add(avi.vercode)
+                self.maxVercodeEachApk[k] = max(self.maxVercodeEachApk[k], avi.vercode)
+                self.realversEachApk[k].add(avi.realver)
+            self.addVariant(k, avi)
+            byName.setdefault(k, []).append(avi)
+        # END: for avi
 
-                self.maxVerEachApk[k] = max(max1, max2)
-            # END: if not k
-            logging.debug('{0} - maxVer: {1}'.format(k, self.maxVerEachApk[k]))
-        # END: for k
-    # END: def getMaxVersionDict
+        for (k, ranking) in rankVersions(byName).items():
+            # On equal versions, the first one stays max
+            if k not in self.maxVerKeyEachApk or ranking['maxKey'] > self.maxVerKeyEachApk[k]:
+                self.maxVerEachApk[k]    = ranking['max']
+                self.maxVerKeyEachApk[k] = ranking['maxKey']
 
-    def getMinSdkDict(self):
+        if byName and self.neededCache:
+            self.neededCache = {}
+    # END: def addApks
+
+    def addVariant(self, k, avi):
         """
-        getMinSdkDict(): Populate a dictionary of the minimum sdk for each APK
+        addVariant(k, avi): Add the arch/sdk/dpi combination of avi to the variant matrix of APK k
         """
-        self.minSdkEachApk = {}
+        variants = self.variantsEachApk.get(k)
+        if variants is None or avi.ver == '':
+            return
 
-        for k in sorted(self.dAllApks.keys()):
-            if k not in self.minSdkEachApk:
-                minSdk = min(int(apk.sdk) for apk in self.dAllApks[k])
-                minSdk = min(minSdk, 19)  # We support down to 19
-                self.minSdkEachApk[k] = minSdk
-            # END: if not k
+        variant = (avi.arch, avi.sdk, avi.dpi)
+        fullKey = avi.getFullVerKey()
+        if variant not in variants or fullKey > variants[variant]:
+            variants[variant] = fullKey
+    # END: def addVariant
 
-            logging.debug('{0} - minSdk: {1}'.format(k, self.minSdkEachApk[k]))
-        # END: for k
-    # END: def getMinSdkDict
+    def getAllApkIds(self, beta=False, playstoreCaps=False):
+        """
+        getAllApkIds(beta, playstoreCaps): Return a tuple of the APK ids in the report
+                                           Each view is built once and then reused until an
+                                           APK id is added to the report
+        """
+        try:
+            return self.apkIdsCache[(beta, playstoreCaps)]
+        except KeyError:
+            pass
+
+        apkIds = self.dAllApks.keys()
+        regexStr = '^.*$'
+        if not beta:
+            regexStr = '^.*\.beta$'
+        reBeta = re.compile(regexStr)
+        if playstoreCaps:
+            apkIds = [apkid.replace('googlecamera', 'GoogleCamera') for apkid in apkIds]
+        self.apkIdsCache[(beta, playstoreCaps)] = tuple(filter(lambda x: not reBeta.match(x), apkIds))
+        return self.apkIdsCache[(beta, playstoreCaps)]
+    # END: def getAllApkIds
 
     def showMissingApks(self):
         """
         showMissingApks(): Populate a list of the needed APKs
         """
-        self.appsNeeded = []
+        self.appsNeeded   = []
+        self.needsEachApk = {}
 
         # NOTE: This code currently only shows older apks (that need updating).
         #       @mfonville has another scheme based up vercode rules for each
         #       apkid that would be more complete
+        ranking = rankVersions(self.dAllApks, self.maxVerKeyEachApk)
         for k in list(self.dAllApks.keys()):
+            logging.debug('{0} - maxVer: {1}, minSdk: {2}'.format(k, self.maxVerEachApk[k], self.minSdkEachApk[k]))
             thisappsneeded = []
-            for a in self.dAllApks[k]:
-                maxApk = ApkVersionInfo(ver=self.maxVerEachApk[k])
-                if a.ver < maxApk.ver:
-                    logging.debug('{0}: {1} < maxApk.ver: {2}'.format(k, a.ver, maxApk.ver))
+            for (a, older) in zip(self.dAllApks[k], ranking[k]['older']):
+                if older:
+                    logging.debug('{0}: {1} < maxApk.ver: {2}'.format(k, a.ver, self.maxVerEachApk[k]))
                     thisappsneeded.append(a.fullString(self.maxVerEachApk[k]))
+                    self.needsEachApk.setdefault(k, set()).add(a.arch)
             if len(thisappsneeded) != 0:
                 self.appsNeeded.extend(thisappsneeded)
         # END: for k in
@@ -135,53 +336,163 @@ class ReportHelper(object):
     def isThisApkNeeded(self, avi):
         """
         def isThisApkNeeded(): Return true if this information passed in is needed per the report data
-                               that this class was initialized with
+                               that this class was initialized with (and the downloads recorded since)
+        """
+        return self.getNotNeededReason(avi) is None
+    # END: def isThisApkNeeded():
+
+    def filterNeeded(self, avis):
+        """
+        def filterNeeded(): Check a batch of candidates at once; the report state of each package
+                            is resolved only once for all its candidates
+                            Returns (needed, rejected): the needed candidates in their original order
+                            and a list of (avi, reason) for the others (see allNotNeededReasons)
+                            Of candidates with the same vercode (or, if unknown, realver) only the
+                            first is needed, as downloading it makes the others redundant
+                            Whether they are older than the report's max version is found for the
+                            whole batch at once by rankVersions()
+        """
+        avis      = list(avis)
+        byPackage = {}  # lowername: positions in avis
+        for (i, avi) in enumerate(avis):
+            byPackage.setdefault(avi.lowername, []).append(i)
+
+        ranking = rankVersions({lowername: [avis[i] for i in positions] for (lowername, positions) in byPackage.items()
+                                if lowername in self.dAllApks}, self.maxVerKeyEachApk)
+
+        reasons = [None] * len(avis)  # By position, the same avi can be in the batch twice
+        for lowername, positions in byPackage.items():
+            state  = self.getApkNeedState(lowername)
+            older  = ranking[lowername]['older'] if lowername in ranking else [None] * len(positions)
+            wanted = set()  # (vercode, realver) of the needed candidates so far
+            for (i, isOlder) in zip(positions, older):
+                avi    = avis[i]
+                reason = self.getNotNeededReason(avi, state, isOlder)
+                if reason is None:
+                    key = (avi.vercode, '') if avi.vercode != 0 else (0, avi.realver)
+                    if key in wanted:
+                        reason = 'DuplicateInBatch'
+                    wanted.add(key)
+                reasons[i] = reason
+
+        needed   = [avi for (avi, reason) in zip(avis, reasons) if reason is None]
+        rejected = [(avi, reason) for (avi, reason) in zip(avis, reasons) if reason is not None]
+        return (needed, rejected)
+    # END: def filterNeeded
+
+    def fillsVariantGap(self, avi):
+        """
+        def fillsVariantGap(): Return False if the report already has the arch/sdk/dpi variant of avi at the
+                               same or a newer version, so fetching the details of avi adds nothing
+                               Versions are compared in full, not truncated by their verParts rule,
+                               as a new build often only differs beyond those parts; a known
+                               vercode that the report lacks is always a gap
+                               Unknown (empty) arch, sdk, dpi or version always count as a gap
+        """
+        variants = self.variantsEachApk.get(avi.lowername)
+        if variants is None or avi.ver == '' or avi.arch == '' or avi.sdk == 0 or avi.dpi == '':
+            return True
+        if avi.vercode != 0 and avi.vercode not in self.vercodesEachApk[avi.lowername]:
+            return True
+
+        have = variants.get((avi.arch, avi.sdk, avi.dpi))
+        return have is None or avi.getFullVerKey() > have
+    # END: def fillsVariantGap
+
+    def getApkNeedState(self, lowername):
+        """
+        def getApkNeedState(): Return the report state of one APK needed by checkNotNeededReason, or None if
+                               the APK is not in the report
+        """
+        if lowername not in self.dAllApks:
+            return None
+
+        betaname = self.betaEachApk.get(lowername)
+        return (self.vercodesEachApk[lowername],
+                self.maxVercodeEachApk[lowername],
+                self.realversEachApk[lowername],
+                self.maxVerKeyEachApk[lowername],
+                self.minSdkEachApk[lowername],
+                self.vercodesEachApk[betaname] if betaname else None,
+                self.maxVerKeyEachApk[betaname] if betaname else None)
+    # END: def getApkNeedState
+
+    def getNotNeededReason(self, avi, state=False, older=None):
+        """
+        def getNotNeededReason(): Return None if the APK is needed, else the reason why not
+                                  Decisions are memoized per candidate until the next recordDownload()
+                                  older is whether avi is older than the max version, if already known
+        """
+        key = (avi.name, avi.lowername, avi.vercode, avi.ver, avi.realver, avi.sdk, avi.target)
+        try:
+            reason = self.neededCache[key]
+            self.neededCacheHits += 1
+            logging.debug('{0}: {1} (cached)'.format(avi.fullString(avi.ver), reason if reason else 'NEED IT'))
+            return reason
+        except KeyError:
+            self.neededCacheMisses += 1
+
+        if state is False:  # None is a valid state: not in the report
+            state = self.getApkNeedState(avi.lowername)
+        reason = self.checkNotNeededReason(avi, state, older)
+        self.neededCache[key] = reason
+        return reason
+    # END: def getNotNeededReason
+
+    def checkNotNeededReason(self, avi, state, older=None):
+        """
+        def checkNotNeededReason(): Uncached version of getNotNeededReason() on the given getApkNeedState()
         """
         # Against the list we are looking for
-        if avi.lowername not in list(self.dAllApks.keys()):
-            return False
+        if state is None:
+            return 'NotInReport'
+        (vercodes, maxVercode, realvers, maxVerKey, minSdk, betaVercodes, betaMaxVerKey) = state
 
         logging.debug(avi.fullString(avi.ver))
         logging.debug('Do we have already vercode?')
         # Do we have the requested vercode already? Or do we have a higher vercode while there is only one variant of these apps?
         if avi.vercode != 0:
-            if ([apk for apk in self.dAllApks[avi.lowername] if apk.vercode == avi.vercode]) or (avi.isVercodeAbsolute() and ([apk for apk in self.dAllApks[avi.lowername] if apk.vercode >= avi.vercode])):
+            if avi.vercode in vercodes:
+                logging.debug('    DON\'T NEED')
+                return 'HaveVercode'
+            if avi.isVercodeAbsolute() and maxVercode >= avi.vercode:
                 logging.debug('    DON\'T NEED')
-                return False
+                return 'HaveHigherVercode'
         else:  # We only need to run the realvername match if we could not compare the vercode itself
             logging.debug('Can we use an absolute realvername match?')
             if avi.isRealverAbsolute():
                 logging.debug('Do we have already a matching absolute realvername?')
                 # Do we have the requested realver already?
                 if avi.realver != '':
-                    if [apk for apk in self.dAllApks[avi.lowername] if apk.realver == avi.realver]:
+                    if avi.realver in realvers:
                         logging.debug('    DON\'T NEED')
-                        return False
+                        return 'HaveRealver'
 
         logging.debug('Is it less than maxVersion?')
         # Is it < maxVersion?
         if avi.ver != '':
-            maxApkInfo = ApkVersionInfo(name=avi.lowername, ver=self.maxVerEachApk[avi.lowername])
-            if avi < maxApkInfo:
+            if older is None:
+                older = avi.getVerKey() < maxVerKey
+            if older:
                 logging.debug('    DON\'T NEED')
-                return False
+                return 'OlderThanMax'
 
         logging.debug('Is SDK a number?')  # If it is not a number, but a letter it is a preview and undesired by Open GApps
         if avi.sdk and not isinstance(avi.sdk, int):
             logging.debug('SdkNotNumber: {0}({1})'.format(avi.name, avi.sdk))
-            return False
+            return 'SdkNotNumber'
 
         logging.debug('Is Target a number?')  # If it is not a number, but a letter it is a preview and undesired by Open GApps
         if avi.target and not isinstance(avi.target, int):
             logging.debug('TargetNotNumber: {0}({1})'.format(avi.name, avi.target))
-            return False
+            return 'TargetNotNumber'
 
         logging.debug('Is it less than minSdk?')
         # Is it < minSdk?
         if avi.sdk != 0:
-            if avi.sdk < self.minSdkEachApk[avi.lowername]:
+            if avi.sdk < minSdk:
                 logging.debug('SdkTooLow: {0}({1})'.format(avi.name, avi.sdk))
-                return False
+                return 'SdkTooLow'
 
         # Are we dealing with a app that has beta support?
         #   Examples: WebView, GoogleApp
@@ -192,28 +503,203 @@ class ReportHelper(object):
                 logging.debug('Do we have already vercode? (beta)')
                 # Do we have the requested vercode (in beta) already?
                 if avi.vercode != 0:
-                    if [apk for apk in self.dAllApks[avi.lowername + '.beta'] if apk.vercode == avi.vercode]:
+                    if avi.vercode in betaVercodes:
                         logging.debug('    DON\'T NEED')
-                        return False
+                        return 'HaveBetaVercode'
 
                 logging.debug('Is it greater than or equal to maxVersion?')
                 # Is it >= maxVersion (for beta)?
                 if avi.ver != '':
-                    maxApkInfo = ApkVersionInfo(name=avi.lowername, ver=self.maxVerEachApk[avi.lowername + '.beta'])
-                    if avi >= maxApkInfo:
+                    if avi.getVerKey() >= betaMaxVerKey:
                         logging.debug('    DON\'T NEED')
-                        return False
+                        return 'NotNewerThanBeta'
                 logging.debug('++++ NEED IT ... (beta)')
 
         # END: if self.needsBetaSupport(avi):
         logging.debug('++++ NEED IT ...')
-        return True
-    # END: def isThisApkNeeded():
+        return None
+    # END: def checkNotNeededReason():
+
+    def recordDownload(self, avi):
+        """
+        def recordDownload(): Add a freshly downloaded APK to the vercode and realver indexes, so
+                              later checks (from any crawler sharing this report) skip it too
+        """
+        if avi.lowername not in self.dAllApks:
+            return
+
+        if avi.vercode != 0:
+            self.vercodesEachApk[avi.lowername].add(avi.vercode)
+            self.maxVercodeEachApk[avi.lowername] = max(self.maxVercodeEachApk[avi.lowername], avi.vercode)
+        if avi.realver != '':
+            self.realversEachApk[avi.lowername].add(avi.realver)
+        if avi.arch != '' and avi.sdk != 0 and avi.dpi != '':
+            self.addVariant(avi.lowername, avi)
+
+        # A download of the max version (or newer) fulfills the need for that arch; a noarch
+        # need is fulfilled by any arch
+        if avi.ver != '' and avi.getVerKey() >= self.maxVerKeyEachApk[avi.lowername]:
+            for arch in self.needsEachApk.get(avi.lowername, ()):
+                if arch == avi.arch or arch == 'all':
+                    markSatisfied(getSatisfiedKey(avi.lowername, arch))
+
+        self.neededCache = {}
+    # END: def recordDownload
+
+    def recordDownloadedFile(self, filename):
+        """
+        def recordDownloadedFile(): recordDownload() for a filename as returned by the crawlers
+                                    ([beta.]<apkid>-<vercode>.apk or [beta.]<apkid>-[<crawler>].apk)
+        """
+        if filename.startswith('beta.'):
+            filename = filename[5:]
+        (name, sep, vercode) = filename.rpartition('-')
+        vercode = vercode.split('.')[0]
+        if sep and vercode.isdigit():
+            self.recordDownload(ApkVersionInfo(name=name, vercode=vercode))
+    # END: def recordDownloadedFile
+
+    def isSatisfied(self):
+        """
+        def isSatisfied(): Return True if stopWhenSatisfied is set and every need found by showMissingApks()
+                           has been downloaded in this run, by any crawler (see claimhelper)
+        """
+        if not self.stopWhenSatisfied:
+            return False
+
+        satisfied = getSatisfied()
+        return all(getSatisfiedKey(name, arch) in satisfied
+                   for (name, archs) in self.needsEachApk.items() for arch in archs)
+    # END: def isSatisfied
+
+    def getNeededCacheStats(self):
+        """
+        def getNeededCacheStats(): Return a description of the isThisApkNeeded cache effectiveness
+        """
+        total = self.neededCacheHits + self.neededCacheMisses
+        return 'isThisApkNeeded cache: {0} hits, {1} misses ({2:.0%} hit rate, {3} entries)'.format(
+            self.neededCacheHits, self.neededCacheMisses, (self.neededCacheHits / total) if total else 0, len(self.neededCache))
+    # END: def getNeededCacheStats
 
     def needsBetaSupport(self, avi):
         """
         def needsBetaSupport(): Returns True if beta support is needed, else False
         """
-        return (avi.lowername.endswith('.beta') or avi.lowername + '.beta' in self.dAllApks)
+        return (avi.lowername.endswith('.beta') or avi.lowername in self.betaEachApk)
     # END: def needsBetaSupport(self, avi):
 # END: class ReportHelper
+
+
+def convertReport(lines, output):
+    """
+    convertReport(lines, output): Write the report_sources.sh lines as an NDJSON report to output
+                                  Numeric sdk and vercode columns become JSON numbers
+    """
+    output.write(json.dumps({'format': reportJsonFormat, 'columns': reportColumns}) + '\n')
+    for line in lines:
+        m = reReportLine.match(line)
+        if m:
+            row = [m.group(column).strip() for column in reportColumns]
+            for i in (2, 5):  # sdk, code
+                if row[i].isdigit():
+                    row[i] = int(row[i])
+            output.write(json.dumps(row) + '\n')
+# END: def convertReport
+
+
+def startReportHash():
+    """
+    startReportHash(): A new hash of a report, seeded with everything else that affects parsing
+                       it (cache layout and version rules); add the report lines with hashLines()
+    """
+    sha = hashlib.sha1()
+    sha.update('{0}|{1}\n'.format(reportCacheVersion, sorted(apkhelper.versionRules.items())).encode('utf-8'))
+    return sha
+# END: def startReportHash
+
+
+def hashLines(lines, sha):
+    """
+    hashLines(lines, sha): Pass the lines through, adding each of them to sha
+    """
+    for line in lines:
+        sha.update(line.encode('utf-8'))
+        yield line
+# END: def hashLines
+
+
+def getReportHash(lines):
+    """
+    getReportHash(lines): Hash of the report content and of everything else that affects
+                          parsing it (cache layout and version rules)
+    """
+    sha = startReportHash()
+    for line in hashLines(lines, sha):
+        pass
+    return sha.hexdigest()
+# END: def getReportHash
+
+
+def loadReport(lines, cachefile=reportCacheFile):
+    """
+    loadReport(lines, cachefile): Return a ReportHelper for the report lines, re-using the parsed
+                                  state from cachefile if it was stored for the same report content
+                                  Looking up the cache takes a pass over the lines first, so lines
+                                  that cannot be read again (e.g. a pipe) are copied to a temporary
+                                  file while they are hashed, to parse them from on a cache miss
+                                  Without a cache file, they are parsed in a single pass
+                                  The cache file is a hash line followed by the pickled ReportHelper
+    """
+    rereadable = isinstance(lines, (list, tuple)) or (hasattr(lines, 'seekable') and lines.seekable())
+    if cachefile and not rereadable and os.path.isfile(cachefile):
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as spool:
+            spool.writelines(lines)
+            spool.seek(0)
+            return loadReport(spool, cachefile)
+
+    if cachefile and rereadable and os.path.isfile(cachefile):
+        reportHash = getReportHash(lines)
+        try:
+            with open(cachefile, 'rb') as cache_file:
+                if cache_file.readline().decode('ascii').strip() == reportHash:
+                    gc.disable()  # Loading only creates objects; collecting in between is wasted time
+                    try:
+                        report = pickle.load(cache_file)
+                    finally:
+                        gc.enable()
+                    logging.debug('Loaded report {0} from {1}'.format(reportHash, cachefile))
+                    for a in sorted(report.appsNeeded):
+                        logging.info(a)
+                    return report
+        except Exception:
+            logging.exception('!!! Ignoring unreadable report cache: "{0}"'.format(cachefile))
+
+        if not isinstance(lines, (list, tuple)):
+            lines.seek(0)
+
+    sha        = startReportHash()
+    report     = ReportHelper(hashLines(lines, sha))
+    reportHash = sha.hexdigest()
+
+    if cachefile:
+        try:
+            tmpfile = '{0}.{1}'.format(cachefile, os.getpid())
+            with open(tmpfile, 'wb') as cache_file:
+                cache_file.write((reportHash + '\n').encode('ascii'))
+                pickle.dump(report, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cachefile)  # Atomic, other crawlers may be reading it
+        except OSError:
+            logging.exception('!!! Unable to write report cache: "{0}"'.format(cachefile))
+    return report
+# END: def loadReport
+
+
+if __name__ == "__main__":
+    """
+    main(): convert a report_sources.sh report (file parameter or stdin) to NDJSON on stdout
+    """
+    if len(sys.argv[1:]) == 1:
+        with open(sys.argv[1]) as lines:
+            convertReport(lines, sys.stdout)
+    else:
+        convertReport(sys.stdin, sys.stdout)
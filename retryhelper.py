@@ -0,0 +1,177 @@
+import collections
+import email.utils
+import glob
+import logging
+import os
+import random
+import struct
+import time
+
+from claimhelper import getRunFile
+from ratehelper import SharedStruct
+
+# Retry policy: exponential backoff with full jitter, bounded by a deadline per call and a
+# retry budget per source, so a failing source cannot multiply its own load
+retryAttempts    = int(os.environ.get('APKCRAWLER_RETRY_ATTEMPTS', 4))  # Tries per call, the first one included
+retryBase        = 0.5    # Seconds of the first backoff, doubled for each next retry
+retryCap         = 30.0   # Seconds a backoff (or Retry-After) may take at most
+retryDeadline    = 120.0  # Seconds after the first try in which a retry may still start
+retryBudgetRatio = 0.2    # Retries each call earns for its source, so retries add at most 20% load...
+retryBudgetMin   = 10.0   # ...after a reserve of this many, which is also what a source starts with
+
+# The retry budget and metrics of a source are shared by all processes of a crawl run (see
+# claimhelper.claimRun), as the pool workers are replaced every few tasks; outside of a run
+# each process has its own
+RetryMetrics  = collections.namedtuple('RetryMetrics', ['calls', 'retries', 'waited', 'budget',
+                                                        'gaveUpAttempts', 'gaveUpDeadline', 'gaveUpBudget'])
+metricsFormat = struct.Struct('<qqddqqq')
+
+metrics    = {}    # SharedStruct of the RetryMetrics by source, see getMetrics()
+metricsPid = None  # Process that opened metrics; a forked worker opens its own
+
+
+def getMetrics(source):
+    """
+    getMetrics(source): The SharedStruct of the RetryMetrics of source
+    """
+    global metricsPid
+    if metricsPid != os.getpid():
+        # The files of the parent process share its flock(), so open them anew
+        for shared in metrics.values():
+            shared.close()
+        metrics.clear()
+        metricsPid = os.getpid()
+
+    shared = metrics.get(source)
+    if shared is None:
+        shared = metrics[source] = SharedStruct(getRunFile('retry.' + source), metricsFormat)
+    return shared
+# END: def getMetrics
+
+
+def countCall(source):
+    """
+    countCall(source): Count a call on behalf of source, which earns it retryBudgetRatio retries
+    """
+    with getMetrics(source).values() as current:
+        sourceMetrics = RetryMetrics(*current)
+        budget        = sourceMetrics.budget if sourceMetrics.calls else retryBudgetMin
+        current[:]    = sourceMetrics._replace(calls=sourceMetrics.calls + 1,
+                                               budget=min(retryBudgetMin, budget + retryBudgetRatio))
+# END: def countCall
+
+
+def takeRetry(source, wait):
+    """
+    takeRetry(source, wait): Spend one retry (after waiting wait seconds) of the budget of source;
+                             return False, counting it as given up, if the budget is spent
+    """
+    with getMetrics(source).values() as current:
+        sourceMetrics = RetryMetrics(*current)
+        if sourceMetrics.budget < 1.0:
+            current[:] = sourceMetrics._replace(gaveUpBudget=sourceMetrics.gaveUpBudget + 1)
+            return False
+        current[:] = sourceMetrics._replace(budget=sourceMetrics.budget - 1.0,
+                                            retries=sourceMetrics.retries + 1,
+                                            waited=sourceMetrics.waited + wait)
+        return True
+# END: def takeRetry
+
+
+def countGiveUp(source, why):
+    """
+    countGiveUp(source, why): Count a call of source that gave up, why is 'Attempts' or 'Deadline'
+    """
+    field = 'gaveUp' + why
+    with getMetrics(source).values() as current:
+        sourceMetrics = RetryMetrics(*current)
+        current[:]    = sourceMetrics._replace(**{field: getattr(sourceMetrics, field) + 1})
+# END: def countGiveUp
+
+
+def getBackoff(retry):
+    """
+    getBackoff(retry): Seconds to wait before retry (1 for the first retry): a random time
+                       between 0 and the exponential backoff ("full jitter")
+    """
+    return random.uniform(0.0, min(retryCap, retryBase * 2 ** (retry - 1)))
+# END: def getBackoff
+
+
+def getRetryAfter(response):
+    """
+    getRetryAfter(response): Seconds the Retry-After header of response asks to wait, or 0.0
+    """
+    value = response.headers.get('Retry-After', '').strip()
+    if value.isdigit():
+        return float(value)
+    if value:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return 0.0
+# END: def getRetryAfter
+
+
+def callWithRetry(source, call, getRetryWait, retryErrors=(), deadline=None):
+    """
+    callWithRetry(source, call, getRetryWait, retryErrors, deadline):
+        Return call(), trying again while the result is transient, i.e. getRetryWait(result) is
+        not None but the seconds the result asks to wait at least (e.g. Retry-After), or call()
+        raised one of retryErrors; a retry waits the larger of that and the backoff, and is only
+        done while attempts, the deadline (seconds, default retryDeadline) and the retry budget
+        of source allow it. The last result is returned (or its error raised) when giving up
+    """
+    countCall(source)
+    stop = time.monotonic() + (retryDeadline if deadline is None else deadline)
+
+    for attempt in range(1, retryAttempts + 1):
+        error = None
+        try:
+            result = call()
+            wait   = getRetryWait(result)
+            if wait is None:
+                return result
+            reason = 'HTTP {0}'.format(result.status_code) if hasattr(result, 'status_code') else 'transient result'
+        except retryErrors as e:
+            (result, error, wait, reason) = (None, e, 0.0, e.__class__.__name__)
+
+        wait = min(retryCap, max(wait, getBackoff(attempt)))
+        if attempt == retryAttempts:
+            countGiveUp(source, 'Attempts')
+        elif time.monotonic() + wait > stop:
+            countGiveUp(source, 'Deadline')
+        elif takeRetry(source, wait):
+            logging.debug('{0}: retry {1} in {2:.1f} seconds ({3})'.format(source, attempt, wait, reason))
+            if hasattr(result, 'close'):
+                result.close()  # Give its connection back to the pool
+            time.sleep(wait)
+            continue
+
+        if error is not None:
+            raise error
+        return result
+# END: def callWithRetry
+
+
+def logMetrics():
+    """
+    logMetrics(): Log the retries spent by each source in this crawl run (or, outside of a run,
+                  this process); call it once, at the end of the run
+    """
+    runFile = getRunFile('retry')
+    if runFile:
+        sources = [os.path.basename(name)[len('retry.'):] for name in glob.glob(runFile + '.*')]
+    else:
+        sources = list(metrics.keys())
+
+    for source in sorted(sources):
+        with getMetrics(source).values() as current:
+            sourceMetrics = RetryMetrics(*current)
+        gaveUp = [('attempts', sourceMetrics.gaveUpAttempts), ('budget', sourceMetrics.gaveUpBudget), ('deadline', sourceMetrics.gaveUpDeadline)]
+        if sourceMetrics.retries or any(count for (why, count) in gaveUp):
+            logging.info('Retries {0}: {1} for {2} calls, {3:.1f} seconds waited, gave up on {4}'.format(
+                         source, sourceMetrics.retries, sourceMetrics.calls, sourceMetrics.waited,
+                         ', '.join('{0} ({1})'.format(count, why) for (why, count) in gaveUp if count) or 'none'))
+# END: def logMetrics
@@ -0,0 +1,99 @@
+import atexit
+import json
+import logging
+import os
+import zipfile
+
+# Where downloads are streamed to, shared with all (forked) crawler processes:
+# '-' for stdout, otherwise a file or FIFO path; unset disables streaming
+streamEnv     = 'APKCRAWLER_STREAM'
+streamJsonEnv = 'APKCRAWLER_STREAM_JSON'  # '1' for NDJSON lines with metadata
+
+streamFd = None  # The open stream target, inherited by forked children, see openStream();
+                 # -1 once its reader went away
+
+
+def startStream(target, asJson=False):
+    """
+    startStream(target, asJson): Stream every download of this process and its children to target
+    """
+    os.environ[streamEnv]     = target
+    os.environ[streamJsonEnv] = '1' if asJson else ''
+    openStream()
+# END: def startStream
+
+
+def openStream():
+    """
+    openStream(): Return the file descriptor of the stream target, opening it on first use;
+                  None if downloads are not streamed (or the reader went away)
+                  It stays open until the process exits, so a FIFO reader only sees EOF once
+                  the crawl is done; open it before starting the crawler processes, so they
+                  all share it
+    """
+    global streamFd
+    target = os.environ.get(streamEnv)
+    if streamFd is None and target:
+        if target == '-':
+            streamFd = 1
+        else:
+            streamFd = os.open(target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            atexit.register(os.close, streamFd)
+    return streamFd if streamFd != -1 else None
+# END: def openStream
+
+
+def isStreamingStdout():
+    """
+    isStreamingStdout(): Return True if downloads are already streamed to stdout, so the
+                         final list of files must not be printed again
+    """
+    return os.environ.get(streamEnv) == '-'
+# END: def isStreamingStdout
+
+
+def streamDownload(apkname, avi, isBeta=False):
+    """
+    streamDownload(apkname, avi, isBeta): Emit one line for a finished download, once it is
+                                          verified to be a complete APK (zip) file
+                                          Text lines are "[beta ]<apkname>", like the final output
+    """
+    global streamFd
+    target = os.environ.get(streamEnv)
+    if not target:
+        return
+
+    try:
+        size = os.path.getsize(apkname)
+        if size == 0 or not zipfile.is_zipfile(apkname):
+            logging.error('!!! Not streaming {0}: not a valid APK'.format(apkname))
+            return
+    except OSError:
+        logging.exception('!!! Not streaming {0}'.format(apkname))
+        return
+
+    if os.environ.get(streamJsonEnv):
+        line = json.dumps({'file'   : apkname,
+                           'beta'   : isBeta,
+                           'name'   : avi.name,
+                           'ver'    : avi.realver,
+                           'vercode': avi.vercode,
+                           'arch'   : avi.arch,
+                           'sdk'    : avi.sdk,
+                           'dpi'    : avi.dpi,
+                           'source' : avi.crawler_name,
+                           'size'   : size}, sort_keys=True)
+    else:
+        line = ('beta ' if isBeta else '') + apkname
+
+    # One write() per line, so lines of concurrent crawler processes never interleave
+    try:
+        fd = openStream()
+        if fd is not None:
+            os.write(fd, (line + '\n').encode('utf-8'))
+    except BrokenPipeError:
+        logging.error('!!! Stopped streaming at {0}: "{1}" is no longer read'.format(apkname, target))
+        streamFd = -1
+    except OSError:
+        logging.exception('!!! Unable to stream {0} to "{1}"'.format(apkname, target))
+# END: def streamDownload
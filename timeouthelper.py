@@ -0,0 +1,113 @@
+import collections
+import logging
+import os
+import time
+
+# Seconds to connect, to wait for each read and for the whole request (body included),
+# by class of request; requests without a class are 'detail' requests
+RequestTimeout = collections.namedtuple('RequestTimeout', ['connect', 'read', 'total'])
+allTimeouts = {
+    'listing' : RequestTimeout(10.0, 30.0,   60.0),  # Search and version list pages
+    'detail'  : RequestTimeout(10.0, 30.0,   60.0),  # Pages and API calls about one APK
+    'download': RequestTimeout(10.0, 60.0, 1800.0),  # The APK itself
+}
+
+# Wall clock time (time.time()) at which the whole crawl must end, shared with all (forked)
+# crawler processes; unset means no budget
+deadlineEnv = 'APKCRAWLER_DEADLINE'
+
+
+def startBudget(seconds):
+    """
+    startBudget(seconds): Give the crawl of this process and its children seconds of wall clock time
+    """
+    os.environ[deadlineEnv] = repr(time.time() + seconds)
+# END: def startBudget
+
+
+def getRemaining():
+    """
+    getRemaining(): Seconds left of the crawl budget, or None if there is no budget
+    """
+    deadline = os.environ.get(deadlineEnv)
+    if not deadline:
+        return None
+    return max(0.0, float(deadline) - time.time())
+# END: def getRemaining
+
+
+def getTimeout(requestClass):
+    """
+    getTimeout(requestClass): The RequestTimeout of requestClass, to pass as timeout of a request
+                              of a session from httphelper.getSession()
+    """
+    return allTimeouts[requestClass]
+# END: def getTimeout
+
+
+def clampTimeout(timeout):
+    """
+    clampTimeout(timeout): timeout (a RequestTimeout), shortened to what is left of the crawl budget
+    """
+    remaining = getRemaining()
+    if remaining is not None and remaining < timeout.total:
+        timeout = RequestTimeout(min(timeout.connect, remaining), min(timeout.read, remaining), remaining)
+    return timeout
+# END: def clampTimeout
+
+
+def sleepWithin(seconds):
+    """
+    sleepWithin(seconds): Sleep seconds and return True, or return False right away if the crawl
+                          budget ends before that
+    """
+    remaining = getRemaining()
+    if remaining is not None and remaining < seconds:
+        return False
+    time.sleep(seconds)
+    return True
+# END: def sleepWithin
+
+
+def runTask(task):
+    """
+    runTask(task): Run one task of mapWithinBudget() in a pool process; return (index, ok, result),
+                   ok is None for a task that was not started because the crawl budget is spent
+    """
+    (func, index, item) = task
+    if getRemaining() == 0.0:
+        return (index, None, None)
+    try:
+        return (index, True, func(item))
+    except Exception:
+        logging.exception('!!! Task failed: {0}'.format(item))
+        return (index, False, None)
+# END: def runTask
+
+
+def mapWithinBudget(pool, func, items, name):
+    """
+    mapWithinBudget(pool, func, items, name): Return (results, skipped): the results of func for
+                                              the items that were done within the crawl budget
+                                              (in the order they finished; failed ones left out)
+                                              and the items that were not started. Once the
+                                              budget is spent no new item is started; those in
+                                              progress end by themselves, as their requests
+                                              time out with the budget (see clampTimeout)
+    """
+    results = []
+    skipped = []
+    tasks   = pool.imap_unordered(runTask, [(func, index, item) for (index, item) in enumerate(items)])
+    for (index, ok, result) in tasks:
+        if ok is None:
+            skipped.append(index)
+        elif ok:
+            results.append(result)
+    pool.close()
+    pool.join()
+
+    skipped = [items[index] for index in sorted(skipped)]
+    if skipped:
+        logging.warning('{0}: crawl budget spent, skipped {1}: {2}'.format(name, len(skipped), ', '.join(str(item) for item in skipped)))
+    return (results, skipped)
+# END: def mapWithinBudget